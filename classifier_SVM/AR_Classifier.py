@@ -9,6 +9,10 @@
 #      (i.e., the magnetic complexity features, filename, and label); a txt file 
 #      weight file used for equalization of features, a txt file performance" 
 #      wih classifier statistics, and a pickle file model with the trained model.
+#     - With numFolds set, instead evaluates the classifier by cross-validation
+#       over numFolds AR-based folds of the feature file (no data copies are 
+#       written; the folds are cached in foldFile) and outputs a txt file with 
+#       the performance of each fold and the mean and std over folds.
 #     - Relies on FeaturesetTools.py.
 #     - Requires the feature file output by Build_Featureset.py and the data
 #       splits (lists of test and val active regions) available on Dryad 
@@ -54,8 +58,11 @@
 
 # Import Libraries and Tools
 import os
+import sys
 import csv
+import time
 import FeaturesetTools
+import FeatureStore
 import numpy as np
 import sklearn.svm
 import pickle
@@ -67,7 +74,7 @@ import pickle
 Folder = './' # folder in which to save results with trailing /
 class_type = 'linear' # 'linear' or 'rbf' kernel for SVM classifier
 suffix = '' # optional suffix for saving different models, leave as '' for no suffix
-classFile  = 'Lat60_Lon60_Nans0_C1.0_24hr'+suffix+'_features.csv' # file containing extracted features
+classFile  = 'Lat60_Lon60_Nans0_C1.0_24hr'+suffix+'_features.csv' # file containing extracted features, csv (as on Dryad) or a FeatureStore directory
 trainDataName  = Folder+'Train_Data_by_AR'+suffix+'.csv' # file with train data, will be read in if exists or created if doesn't
 testDataName   = Folder+'Test_Data_by_AR'+suffix+'.csv' # file with test data, will be read in if exists or created if doesn't
 valDataName    = Folder+'Validation_data_by_AR'+suffix+'.csv' # file with val data, will be read in if exists or created if doesn't
@@ -75,6 +82,11 @@ weightData = Folder+'Weight_Lat60_Lon60_Nans0_C1.0_24hr'+suffix+'.txt' #weights
 outfile = Folder+'ARClassifierStats_weighted_trainvaltest_'+class_type+suffix+'.txt' # output file for statistics; will also be used to define the .pickle filename
 testARList = '../List_of_AR_in_Test_Data_by_AR.csv' #list of active regions in TestData, will be created by randomly assigning 10% of ARs if does not exist in the location specified
 valARList  = '../List_of_AR_in_Validation_data_by_AR.csv' #list of active regions in ValData, will be created by randomly asigning 10% of ARs if does not exist in the location specified
+numFolds = None # number of AR-based cross-validation folds of classFile, or None to use the train, test and val sets
+foldSeed = 0 # seed of the random assignment of active regions to folds
+stratifyFolds = True # True to spread flaring active regions evenly over the folds
+featureDtype = float # float or np.float32 features, np.float32 halves the memory used
+foldFile = Folder+'Folds_Lat60_Lon60_Nans0_C1.0_24hr'+suffix+'.npz' # cache of the folds, reused for the same classFile, numFolds, foldSeed and stratifyFolds
 ## End User Definitions
 
 # Generate filenames
@@ -85,6 +97,63 @@ valDataName    = Folder + '/' + valDataName
 testARList = Folder + '/' + testARList
 valARList  = Folder + '/' + valARList
 weightData = Folder + '/' + weightData
+foldFile   = Folder + '/' + foldFile
+
+# Performance metrics of predictions P of labeled data
+def scores(label,P):
+    C = sklearn.metrics.confusion_matrix(label,P,labels=[1,0])
+    tp = C[0,0]; fn=C[0,1]; fp=C[1,0]; tn=C[1,1];
+    tpr = float(tp)/(tp+fn)
+    tnr = float(tn)/(tn+fp)
+    hss = float(2*((tp*tn)-(fn*fp)))/((tp+fn)*(fn+tn) + (tp+fp)*(fp+tn))
+    tss = tpr - (1. - tnr)
+    return tpr, tnr, hss, tss
+
+def crossValidate():
+    """
+    Cross-validation over AR-based folds of classFile: the folds are row
+    indexes into the full feature matrix, equalized with the weights of the
+    training rows of each fold, so no train or test files are written.
+    """
+    
+    print('\nLoading', os.path.basename(classFile))
+    started = time.perf_counter()
+    classData, classLabel, classNames = FeaturesetTools.loadFeatureset(classFile,featureDtype)
+    print('Loaded',len(classData),'entries in','%.2f' % (time.perf_counter()-started),'s')
+
+    print('Creating', numFolds, 'AR-based folds')
+    folds = FeaturesetTools.createARFolds(classFile,foldFile,numFolds,foldSeed,stratifyFolds,
+                                          classLabel,classNames)
+
+    results = []
+    for n,(trainRows,testRows) in enumerate(folds):
+        print('Training and testing fold',n+1,'of',numFolds)
+        trainData, weights = FeaturesetTools.equalizeTrainData(classData[trainRows])
+        testData = FeaturesetTools.equalizeNewData(classData[testRows],weights)
+        classifier = sklearn.svm.SVC(kernel = 'linear',gamma='auto',class_weight='balanced')
+        classifier.fit(trainData,classLabel[trainRows])
+        results.append(scores(classLabel[testRows],classifier.predict(testData)))
+
+    # Save Results
+    print('Saving Results')
+    with open(outfile[:-4]+'_'+str(numFolds)+'fold.txt', 'w+') as f:
+        for n,(tpr,tnr,hss,tss) in enumerate(results):
+            f.write('Fold '+str(n+1)+' test data performance')
+            f.write('\nTPR = '+str(tpr)+'\nTNR = '+str(tnr)+'\nHSS = '+str(hss)+'\nTSS = '+str(tss)+'\n')
+        f.write('Mean (std) over folds')
+        for name,values in zip(['TPR','TNR','HSS','TSS'],np.transpose(results)):
+            f.write('\n'+name+' = '+str(np.mean(values))+' ('+str(np.std(values))+')')
+
+if numFolds is not None:
+    crossValidate()
+    print('Process Complete')
+    sys.exit()
+
+# A FeatureStore classFile gives FeatureStore train, test and val sets
+if FeatureStore.isStore(classFile):
+    trainDataName = os.path.splitext(trainDataName)[0]+'.store'
+    testDataName  = os.path.splitext(testDataName)[0]+'.store'
+    valDataName   = os.path.splitext(valDataName)[0]+'.store'
 
 # Generate Files
 
@@ -108,20 +177,12 @@ print('\nLoading', os.path.basename(trainDataName),'and',
       os.path.basename(testDataName),'and',
       os.path.basename(valDataName))
 
-# Read and prepare trainData
-trainData = np.genfromtxt(trainDataName,delimiter=',',dtype=float,usecols=range(29))
-trainLabel = np.genfromtxt(trainDataName,delimiter=',',dtype=int,usecols=29)
-trainNames = np.genfromtxt(trainDataName,delimiter=',',dtype=str,usecols=30)
-
-# Read and prpare testData
-testData = np.genfromtxt(testDataName,delimiter=',',dtype=float,usecols=range(29))
-testLabel = np.genfromtxt(testDataName,delimiter=',',dtype=int,usecols=29)
-testNames = np.genfromtxt(testDataName,delimiter=',',dtype=str,usecols=30)
-
-# Read and prpare valData
-valData = np.genfromtxt(valDataName,delimiter=',',dtype=float,usecols=range(29))
-valLabel = np.genfromtxt(valDataName,delimiter=',',dtype=int,usecols=29)
-valNames = np.genfromtxt(valDataName,delimiter=',',dtype=str,usecols=30)
+started = time.perf_counter()
+trainData, trainLabel, trainNames = FeaturesetTools.loadFeatureset(trainDataName,featureDtype)
+testData, testLabel, testNames = FeaturesetTools.loadFeatureset(testDataName,featureDtype)
+valData, valLabel, valNames = FeaturesetTools.loadFeatureset(valDataName,featureDtype)
+print('Loaded',len(trainData)+len(testData)+len(valData),'entries in',
+      '%.2f' % (time.perf_counter()-started),'s')
 
 print('Training')
 #create and train svm, then use on test data
@@ -133,17 +194,8 @@ modelfile = outfile[:-4]+'_model.pickle'
 pickle.dump(classifier,open(modelfile,'wb'))
 
 print('Applying learned classifier to test data')
-P = classifier.predict(testData)
-C = sklearn.metrics.confusion_matrix(testLabel,P,labels=[1,0])
-   
-#evaluate various performance metrics
-tp = C[0,0]; fn=C[0,1]; fp=C[1,0]; tn=C[1,1];
-tpr = float(tp)/(tp+fn)
-tnr = float(tn)/(tn+fp)
-    
-hss = float(2*((tp*tn)-(fn*fp)))/((tp+fn)*(fn+tn) + (tp+fp)*(fp+tn))
-tss = tpr - (1. - tnr)
-    
+tpr, tnr, hss, tss = scores(testLabel,classifier.predict(testData))
+
 # Save Results
 
 # Inform User
@@ -161,16 +213,8 @@ with open(outfile, 'w+') as f:
     f.write(str(tss))
 
 print('Applying learned classifier to validation data')
-P = classifier.predict(valData)
-C = sklearn.metrics.confusion_matrix(valLabel,P,labels=[1,0])
-#evaluate various performance metrics
-tp = C[0,0]; fn=C[0,1]; fp=C[1,0]; tn=C[1,1];
-tpr = float(tp)/(tp+fn)
-tnr = float(tn)/(tn+fp)
-    
-hss = float(2*((tp*tn)-(fn*fp)))/((tp+fn)*(fn+tn) + (tp+fp)*(fp+tn))
-tss = tpr - (1. - tnr)
-    
+tpr, tnr, hss, tss = scores(valLabel,classifier.predict(valData))
+
 print('Saving Results')
 # Print Results
 with open(outfile, 'a+') as f:
@@ -185,16 +229,8 @@ with open(outfile, 'a+') as f:
     f.write(str(tss))
 
 print('Applying learned classifier to training data')
-P = classifier.predict(trainData)
-C = sklearn.metrics.confusion_matrix(trainLabel,P,labels=[1,0])
-#evaluate various performance metrics
-tp = C[0,0]; fn=C[0,1]; fp=C[1,0]; tn=C[1,1];
-tpr = float(tp)/(tp+fn)
-tnr = float(tn)/(tn+fp)
-    
-hss = float(2*((tp*tn)-(fn*fp)))/((tp+fn)*(fn+tn) + (tp+fp)*(fp+tn))
-tss = tpr - (1. - tnr)
-    
+tpr, tnr, hss, tss = scores(trainLabel,classifier.predict(trainData))
+
 print('Saving Results')
 # Print Results
 with open(outfile, 'a+') as f:
@@ -0,0 +1,70 @@
+#-------------------------------------------------------------------------------
+# Benchmark_Filters.py
+#
+# Times the filtering backends available in FunctionsP3.py (gradient and 
+# neutral line smoothing) on random images of the reduced (224x224) and full
+# (600x600) resolution sizes, and reports the per-image speedup and maximum
+# absolute difference of each backend relative to the convolve2d reference.
+# Each image is also run with a band of NaNs (as in patches near the limb), 
+# for which the number of pixels where the NaN pattern differs from the 
+# reference is reported too.
+#
+#  - Relies on FunctionsP3.py
+#  - Edit the lines under ## User Definitions to specify image sizes and the
+#    number of repetitions.
+#
+# Copyright 2022 Laura Boucheron, Jeremy Grajeda, Ellery Wuest
+# This file is part of AR-flares
+#
+# AR-flares is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# AR-flares is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# AR-flares. If not, see <https://www.gnu.org/licenses/>.
+
+import time
+import numpy as np
+import FunctionsP3
+
+## User Definitions
+sizes = [224,600] # image sizes to benchmark
+repeats = 20 # number of timed repetitions per backend and size
+## End User Definitions
+
+def timeFilter(function,image):
+    # Return the mean time per call and the result of the last call
+    start = time.perf_counter()
+    for i in range(repeats):
+        result = function(image)
+    return (time.perf_counter()-start)/repeats, result
+
+if __name__=='__main__':
+    rng = np.random.default_rng(0)
+    for size in sizes:
+        # Random field with the dynamic range of an HMI magnetogram, without
+        # and with a band of NaNs
+        image = rng.normal(0,500,(size,size))
+        nanImage = image.copy()
+        nanImage[:,:size//8] = np.nan
+        for name,field in (('',image),(' with NaNs',nanImage)):
+            print('\nImage size '+str(size)+'x'+str(size)+name)
+            for function in (FunctionsP3.gradient,FunctionsP3.smoothNL):
+                reference = None
+                for backend in FunctionsP3.filterBackends:
+                    FunctionsP3.setFilterBackend(backend)
+                    elapsed, result = timeFilter(function,field)
+                    if reference is None:
+                        reference = (elapsed,result)
+                    nanDiff = np.count_nonzero(np.isnan(result) != np.isnan(reference[1]))
+                    diff = np.absolute(result-reference[1])
+                    maxDiff = np.nanmax(diff) if not np.all(np.isnan(diff)) else 0.
+                    print('  %-9s %-10s %8.3f ms  speedup %5.2fx  max abs diff %.2e  NaN mismatch %d'
+                          % (function.__name__,backend,1000*elapsed,
+                             reference[0]/elapsed,maxDiff,nanDiff))
+    FunctionsP3.setFilterBackend('convolve2d')
@@ -0,0 +1,143 @@
+#-------------------------------------------------------------------------------
+# Benchmark_FunctionsP3.py
+#
+# Benchmark suite of the feature extraction functions (FunctionsP3.gradient,
+# Gradfeat, NLfeat, wavel, fluxValues and FeaturesetTools.concatVals) on the
+# deterministic synthetic magnetograms of SyntheticMagnetograms.py (bipolar,
+# multipolar, NaN and flat fields at 224x224 and 600x600).
+#
+#  - Run the benchmark and write the timings to a json file:
+#       python Benchmark_FunctionsP3.py run [--out FILE] [--repeats N]
+#                                           [--sizes 224 600] [--backend B]
+#    Each function is called repeats times on each image; the json file holds
+#    the median, minimum and mean time per call in seconds for each
+#    function/image pair, with the settings and library versions of the run.
+#  - Compare two runs and flag regressions:
+#       python Benchmark_FunctionsP3.py compare <baseFile> <newFile>
+#                                               [--threshold 0.1]
+#    A function/image pair whose median time grew by more than the threshold
+#    (a fraction) is flagged as a regression, and the exit status is 1 if any
+#    regression is found, so the comparison can be used in scripts.
+#  - Median times are robust to a few slow repetitions, but both runs should
+#    be made on the same idle machine.
+#
+# Copyright 2022 Laura Boucheron, Jeremy Grajeda, Ellery Wuest
+# This file is part of AR-flares
+#
+# AR-flares is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# AR-flares is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# AR-flares. If not, see <https://www.gnu.org/licenses/>.
+
+import sys
+import json
+import time
+import platform
+import argparse
+import numpy as np
+import scipy
+import FunctionsP3
+import FeaturesetTools
+import SyntheticMagnetograms
+
+functions = [FunctionsP3.gradient,FunctionsP3.Gradfeat,FunctionsP3.NLfeat,
+             FunctionsP3.wavel,FunctionsP3.fluxValues,FeaturesetTools.concatVals]
+
+def timeFunction(function,image,repeats):
+    # time per call of each repetition, after one untimed warm-up call
+    function(image)
+    times = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        function(image)
+        times.append(time.perf_counter()-start)
+    return times
+
+def runBenchmark(sizes,repeats):
+    """
+    Returns the benchmark results as a dict with the settings of the run
+    ('settings') and the timings of each function on each synthetic image
+    ('results', keyed by function/image).
+    """
+
+    results = dict()
+    for name,image in SyntheticMagnetograms.benchmarkSet(sizes).items():
+        for function in functions:
+            times = timeFunction(function,image,repeats)
+            key = function.__name__+'/'+name
+            results[key] = {'median':float(np.median(times)),'min':min(times),
+                            'mean':float(np.mean(times)),'repeats':repeats}
+            print('  %-28s %10.3f ms' % (key,1000*results[key]['median']))
+    settings = {'filterBackend':FunctionsP3.filterBackend,
+                'gradMedianBins':FunctionsP3.gradMedianBins,
+                'roiFraction':FunctionsP3.roiFraction,
+                'python':platform.python_version(),'numpy':np.__version__,
+                'scipy':scipy.__version__,'machine':platform.node(),
+                'date':time.strftime('%Y-%m-%d %H:%M:%S')}
+    return {'settings':settings,'results':results}
+
+def compareRuns(base,new,threshold):
+    """
+    Prints the median time ratio (new/base) of each function/image pair of two
+    benchmark runs and returns the list of pairs slower by more than
+    threshold.
+    """
+
+    regressions = []
+    for key in sorted(set(base['results']) & set(new['results'])):
+        ratio = new['results'][key]['median']/base['results'][key]['median']
+        if ratio > 1+threshold:
+            flag = 'REGRESSION'
+            regressions.append(key)
+        elif ratio < 1-threshold:
+            flag = 'faster'
+        else:
+            flag = ''
+        print('  %-28s %10.3f ms %10.3f ms %7.2fx  %s'
+              % (key,1000*base['results'][key]['median'],
+                 1000*new['results'][key]['median'],ratio,flag))
+    for key in sorted(set(base['results']) ^ set(new['results'])):
+        print('  %-28s only in one run' % key)
+    return regressions
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of FunctionsP3 on synthetic magnetograms')
+    parser.add_argument('command',choices=['run','compare'])
+    parser.add_argument('files',nargs='*',help='baseFile and newFile for compare')
+    parser.add_argument('--out',default='benchmark_FunctionsP3.json',
+                        help='result file of run')
+    parser.add_argument('--repeats',type=int,default=10,
+                        help='timed calls per function and image')
+    parser.add_argument('--sizes',type=int,nargs='+',default=[224,600],
+                        help='image sizes')
+    parser.add_argument('--backend',default='convolve2d',choices=FunctionsP3.filterBackends,
+                        help='filtering backend of FunctionsP3')
+    parser.add_argument('--threshold',type=float,default=0.1,
+                        help='relative slowdown flagged as a regression')
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        FunctionsP3.setFilterBackend(args.backend)
+        print('Benchmarking with the',args.backend,'backend,',args.repeats,'repeats')
+        results = runBenchmark(args.sizes,args.repeats)
+        with open(args.out,'w') as f:
+            json.dump(results,f,indent=1)
+        print('Results written to',args.out)
+    else:
+        if len(args.files) != 2:
+            parser.error('compare needs a baseFile and a newFile')
+        with open(args.files[0]) as f:
+            base = json.load(f)
+        with open(args.files[1]) as f:
+            new = json.load(f)
+        print('  %-28s %13s %13s %8s' % ('function/image','base','new','ratio'))
+        regressions = compareRuns(base,new,args.threshold)
+        print(str(len(regressions))+' regressions above '+str(100*args.threshold)+'%')
+        sys.exit(1 if regressions else 0)
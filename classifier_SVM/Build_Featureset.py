@@ -51,7 +51,7 @@
 #       the classifier_SVM/ directory (i.e., the same directory as the SVM 
 #       code), although subsequent code will allow you to specify the path to 
 #       those files.
-#  - Relies on FeaturesetTools.py.
+#  - Relies on FeaturesetTools.py and general_code/DatasetManifest.py.
 #  - Requires the AR Dataset:
 #     - The flare labesl file (C1.0_24hr_224_png_Labels.txt or 
 #       C1.0_24hr_Labels.txt, available on Dryad at <insert link here> (reduced 
@@ -93,14 +93,20 @@
 # AR-flares. If not, see <https://www.gnu.org/licenses/>.
                
 import os
-import glob
+import sys
 import csv
+import json
+import time
 import numpy as np
-from astropy.io import fits
 import FeaturesetTools 
-import imageio
-from multiprocessing import Pool, Manager
+import FunctionsP3
+import FeatureCache
+import FeatureStore
+import StageTimer
+from multiprocessing import Pool
 from functools import partial
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','general_code'))
+import DatasetManifest
 
 ## User Definitions
 # Modify the following to reflect the location of the label file (available with the dataset on Dryad)
@@ -109,27 +115,70 @@ labelFile = '/mnt/solar_flares/AR_Dataset/C1.0_24hr_Labels.txt' # label file
 datasetDir = '/mnt/solar_flares/AR_Dataset/Lat60_Lon60_Nans0/' # dataset directory location
 # Specify the desired output location an filename
 outFile = 'Lat60_Lon60_Nans0_C1.0_24hr_features.csv' # output file
+# Specify the output format, a csv file or a binary FeatureStore directory.
+# csv is the default as the feature files published on Dryad, and the default
+# classFile of AR_Classifier.py, are csv files; with 'store' set outFile to a
+# .store name, AR_Classifier.py and FeaturesetTools.py read either format
+# (convert with python FeatureStore.py tostore/tocsv)
+outputFormat = 'csv' # 'csv' or 'store' (see FeatureStore.py)
 # Specify whether the dataset is fits or png
 file_extension = 'fits' # fits or png
+# Specify the filtering backend used for the gradient and neutral line smoothing
+filterBackend = 'convolve2d' # 'convolve2d' (reference), 'separable', or 'fft'
+# Specify the number of histogram bins for the gradient median
+gradMedianBins = None # None for the exact median
+# Specify whether neutral lines are only extracted near strong-field regions
+roiFraction = None # None for the whole image, or a fraction of max |B| (e.g. 0.2)
+roiMargin = 10 # margin in pixels around each strong-field region
+# Specify the floating point precision used for feature extraction
+computeDtype = 'float64' # 'float64' or 'float32' (see Compare_Precision.py)
+# Specify whether each worker processes a whole AR directory as an image stack
+batchByAR = False # True or False
+# Specify the features to compute, as a list of names from FunctionsP3.featureNames
+featureList = None # None computes all 29 features
+# Specify the dataset manifest listing the image files (see DatasetManifest.py)
+manifestFile = None # None for a manifest_*_<file_extension>.csv in the working directory
+# Specify whether to stream results to outFile in checkpointed batches; an
+# interrupted run restarted with the same settings skips the files already done,
+# a run restarted with other settings or feature code is refused
+streaming = False # True or False
+checkpointSize = 1000 # number of entries written per checkpointed batch
+# Specify a persistent feature cache so that rebuilds only extract features for
+# new or changed files (see FeatureCache.py for statistics and pruning)
+cacheFile = None # path of the cache file, or None for no cache
+cacheKey = 'stat' # 'stat' (path, size and mtime) or 'content' (hash of file bytes)
+# Specify the number of worker processes and how files are scheduled on them
+numWorkers = 40 # number of worker processes
+scheduling = 'size' # 'size' (largest files first) or 'order' (file order)
+chunkFactor = 4 # each chunk of tasks holds 1/(chunkFactor*numWorkers) of the remaining cost
+# Specify a json file for per-stage timing statistics of each worker (see StageTimer.py)
+timingFile = None # None for no timing
 ## End User Definitions
 
-def extract_features(Labels,filename):
-    # open image
-    if file_extension=='fits':
-        with fits.open(filename) as Img:
-            Img.verify('silentfix')
-            Img = Img[1].data
-    elif file_extension=='png':
-        Img = imageio.imread(filename).astype(float)
-        Img = Img-128 # offset so that zero flux is at zero
+# Set at import so that the pool workers use the same settings
+FunctionsP3.setFilterBackend(filterBackend)
+FunctionsP3.gradMedianBins = gradMedianBins
+FunctionsP3.roiFraction = roiFraction
+FunctionsP3.roiMargin = roiMargin
+StageTimer.enabled = timingFile is not None
 
-            
-    # Inform User
-    print('Building entry for '+os.path.basename(filename))
-                   
-    # Extract Features
-    features = FeaturesetTools.concatVals(Img)
+def feature_version():
+    # version of the feature code and of the settings that change the features
+    settings = {'filterBackend':filterBackend,'gradMedianBins':gradMedianBins,
+                'roiFraction':roiFraction,'roiMargin':roiMargin,
+                'computeDtype':computeDtype,'featureList':featureList,
+                'file_extension':file_extension}
+    return FeatureCache.featureVersion(settings)
 
+def load_image(filename):
+    # open image as a native-endian array of the compute dtype
+    started = StageTimer.start()
+    Img = FeaturesetTools.loadMagnetogram(filename,computeDtype)
+    StageTimer.record('load',started)
+    return Img
+
+def join_label(Labels,filename):
+    # labels are joined in the main process, the workers only extract features
     if os.path.basename(filename) in Labels:
         if Labels[os.path.basename(filename)]=='0':
             label = '0,'+Labels[os.path.basename(filename)]
@@ -137,11 +186,147 @@ def extract_features(Labels,filename):
             label = '1,'+Labels[os.path.basename(filename)]
     else:
         label = 'NaN'
+    return label
 
-    return features,label
+def extract_features(filename):
+    # open image
+    Img = load_image(filename)
+            
+    # Inform User
+    print('Building entry for '+os.path.basename(filename))
+                   
+    # Extract Features
+    context = FunctionsP3.FeatureContext(Img)
+    features = FeaturesetTools.concatVals(context,featureList)
+    if roiFraction is not None:
+        print('  skipped %.1f%% of the area of ' % (100*context.roiSkipped)
+              +os.path.basename(filename))
+
+    return features
+
+def extract_features_AR(filenames):
+    # open all images of one AR
+    Imgs = [load_image(filename) for filename in filenames]
+    
+    # Inform User
+    print('Building entries for AR '+os.path.basename(os.path.dirname(filenames[0])))
+    
+    # Extract Features, stacking together images of the same size
+    features = [None]*len(Imgs)
+    shapes = [np.shape(Img) for Img in Imgs]
+    for shape in set(shapes):
+        index = [i for i in range(len(Imgs)) if shapes[i]==shape]
+        context = FunctionsP3.FeatureContext(np.asarray([Imgs[i] for i in index]))
+        stack = FeaturesetTools.concatValsStack(context,featureList)
+        for n,(i,row) in enumerate(zip(index,stack)):
+            features[i] = row
+            if roiFraction is not None:
+                print('  skipped %.1f%% of the area of ' % (100*context.frame(n).roiSkipped)
+                      +os.path.basename(filenames[i]))
+    
+    return features
+
+def extract_entries(task):
+    # task is a filename, or the list of filenames of one AR with batchByAR
+    if batchByAR:
+        filenames = task
+        features = extract_features_AR(filenames)
+    else:
+        filenames = [task]
+        features = [extract_features(task)]
+    return [(os.path.basename(filename),row) 
+            for filename,row in zip(filenames,features)]
+
+def extract_chunk(chunk):
+    # extract the entries of a chunk of tasks, with the busy time and stage
+    # timings of the worker
+    start = time.perf_counter()
+    entries = [entry for task in chunk for entry in extract_entries(task)]
+    return os.getpid(), time.perf_counter()-start, entries, StageTimer.collect()
+
+def schedule(tasks,costs):
+    # Orders tasks by decreasing estimated cost (with scheduling = 'size') and
+    # groups them in chunks holding a decreasing share of the remaining cost,
+    # so that the expensive tasks are started first and the chunks shrink to
+    # single tasks towards the end of the run, where they fill idle workers.
+    if scheduling == 'size':
+        order = sorted(range(len(tasks)),key=lambda i: -costs[i])
+    else:
+        order = range(len(tasks))
+    remaining = float(sum(costs))
+    chunks = []
+    chunk = []
+    chunkCost = 0
+    for i in order:
+        chunk.append(tasks[i])
+        chunkCost += costs[i]
+        if chunkCost >= remaining/(chunkFactor*numWorkers):
+            chunks.append(chunk)
+            remaining -= chunkCost
+            chunk = []
+            chunkCost = 0
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+def log_utilization(workers,elapsed):
+    # per worker number of files, busy time and fraction of the run busy
+    print('Worker utilization over %.1f s of extraction' % elapsed)
+    for n,pid in enumerate(sorted(workers)):
+        files,busy = workers[pid]
+        print('  worker %2d (pid %d): %6d files, %8.1f s busy, %5.1f%% utilized'
+              % (n,pid,files,busy,100*busy/max(elapsed,1e-9)))
+    busy = sum([worker[1] for worker in workers.values()])
+    print('  mean utilization %.1f%% of %d workers'
+          % (100*busy/max(elapsed*numWorkers,1e-9),numWorkers))
+
+def entry_columns(entries):
+    # columns of the feature file (features, label and filename) for a list 
+    # of (name, features, label) entries
+    names,features,labels = zip(*entries)
+    return list(np.asarray(features,dtype=float).T)+[np.asarray(labels),np.asarray(names)]
+
+def format_entries(entries):
+    # lines of the feature file, as written by FeaturesetTools.writeMe
+    if not entries:
+        return ''
+    return FeaturesetTools.formatColumns(entry_columns(entries))
+
+def load_checkpoint(checkpointFile):
+    # Each line of the checkpoint manifest records the size of outFile after
+    # a completed batch and the files in that batch, the first line also the
+    # feature version of the run. Returns the files done, the size of outFile
+    # up to the last completed batch and the feature version.
+    done = set()
+    size = None
+    version = None
+    if os.path.exists(checkpointFile):
+        with open(checkpointFile) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break # partially written last line
+                size = record['size']
+                done.update(record['files'])
+                version = record.get('version',version)
+    return done,size,version
+
+def write_batch(out,checkpoint,batch,version=None):
+    # append a batch of entries to outFile, then record it in the checkpoint
+    # (with the feature version for the first record)
+    out.write(format_entries(batch))
+    out.flush()
+    os.fsync(out.fileno())
+    record = {'size':out.tell(),'files':[entry[0] for entry in batch]}
+    if version is not None:
+        record['version'] = version
+    checkpoint.write(json.dumps(record)+'\n')
+    checkpoint.flush()
+    os.fsync(checkpoint.fileno())
 
 if __name__=='__main__':
-    p = Pool(40)
+    p = Pool(numWorkers)
     
     # Load labelFile
     #inform User
@@ -152,29 +337,167 @@ if __name__=='__main__':
     with open(labelFile) as f:
         csvData = csv.reader(f,delimiter = ',')
         Labels = dict(csvData)
-    Labels = Manager().dict(Labels)
 
     # Find all data files
-    print('Finding image files (this may take a while)')
-    filenames = sorted(glob.glob(datasetDir+'/*/*.'+file_extension))
-    fnums = range(len(filenames))
+    print('Finding image files from the dataset manifest')
+    manifest = DatasetManifest.buildManifest(datasetDir,file_extension,manifestFile)
+    filenames = [os.path.join(datasetDir,entry.path) for entry in manifest]
+    # file sizes estimate the extraction cost of each file
+    sizes = dict((os.path.join(datasetDir,entry.path),entry.size) for entry in manifest)
 
-    # Fill filenames_base
-    filenames_base = list()
-    for filename in filenames:
-        filenames_base.append(os.path.basename(filename))
+    # Look up features of unchanged files in the cache
+    cached = dict()
+    if cacheFile is not None:
+        cache = FeatureCache.FeatureCache(cacheFile,feature_version())
+        print('Checking feature cache',cacheFile)
+        keys = dict(zip(filenames,p.map(partial(FeatureCache.fileKey,mode=cacheKey),
+                                        filenames,chunksize=64)))
+        found = cache.lookup(keys.values())
+        for filename in filenames:
+            if keys[filename] in found:
+                cached[filename] = (os.path.basename(filename),found[keys[filename]],
+                                    join_label(Labels,filename))
+        print('  found',len(cached),'of',len(filenames),'files in the cache')
+        keyOf = dict((os.path.basename(filename),(keys[filename],os.path.abspath(filename)))
+                     for filename in filenames)
+    
+    def cache_entries(entries):
+        # store newly extracted features in the cache
+        if cacheFile is not None:
+            cache.store([keyOf[name]+(features,) for name,features,label in entries])
 
     # extract features
     print('Extracting features')
-    feature_matrix,label_vector = zip(*p.map(partial(extract_features,Labels),filenames))
+    if featureList is not None:
+        print('Computing',len(featureList),'features from intermediates',
+              FunctionsP3.requiredIntermediates(featureList))
+    uncached = [filename for filename in filenames if filename not in cached]
+    if batchByAR:
+        # group files by AR directory, keeping the sorted file order
+        ARfiles = dict()
+        for filename in uncached:
+            ARfiles.setdefault(os.path.dirname(filename),[]).append(filename)
+        tasks = list(ARfiles.values())
+    else:
+        tasks = uncached
 
-    # Create Outfile 
-    # Inform User
-    print ('Creating',outFile)
-    #outFile = outFile+'_sr'+str(sr)+'x'+str(sr)+'.csv' 
-    np.savetxt(outFile,np.hstack((np.asarray(feature_matrix),\
-               np.expand_dims(np.asarray(label_vector),1),\
-               np.expand_dims(np.asarray(filenames_base),1))),\
-               delimiter=',',fmt='%s')
-#Inform User
-print('Process Complete')
+    # record the column names in a commented header line
+    columns = FunctionsP3.featureNames if featureList is None else featureList
+    header = ','.join(list(columns)+['Flare label','Flare class','Filename'])
+    
+    # streaming always appends to a csv file, which is converted to a
+    # FeatureStore at the end of the run if requested
+    if outputFormat == 'store':
+        csvFile = os.path.splitext(outFile)[0]+'.csv'
+    else:
+        csvFile = outFile
+    
+    if streaming:
+        checkpointFile = csvFile+'.checkpoint'
+        done,size,version = load_checkpoint(checkpointFile)
+        if size is None:
+            # New run, start csvFile with the header
+            print('Creating',csvFile)
+            with open(csvFile,'w') as out, open(checkpointFile,'w') as checkpoint:
+                out.write('# '+header+'\n')
+                write_batch(out,checkpoint,[],feature_version())
+        elif version != feature_version():
+            # Entries of other settings or feature code would be mixed in
+            sys.exit(csvFile+' was started with other settings or feature code, '
+                     'delete it and '+checkpointFile+' to start over')
+        else:
+            # Restarted run, drop anything written after the last checkpoint
+            print('Resuming',csvFile,'with',len(done),'entries already done')
+            with open(csvFile,'r+') as out:
+                out.truncate(size)
+            # Rewrite the checkpoint as a single record, dropping any
+            # partially written line
+            with open(checkpointFile+'.tmp','w') as checkpoint:
+                checkpoint.write(json.dumps({'size':size,'files':sorted(done),
+                                             'version':version})+'\n')
+            os.replace(checkpointFile+'.tmp',checkpointFile)
+        if batchByAR:
+            tasks = [task for task in tasks 
+                     if not all(os.path.basename(f) in done for f in task)]
+        else:
+            tasks = [task for task in tasks if os.path.basename(task) not in done]
+    
+    # Schedule the tasks in chunks, largest first
+    if batchByAR:
+        costs = [sum([sizes[filename] for filename in task]) for task in tasks]
+    else:
+        costs = [sizes[task] for task in tasks]
+    chunks = schedule(tasks,costs)
+    print('Scheduled',len(tasks),'tasks in',len(chunks),'chunks on',numWorkers,'workers')
+    workers = dict()
+    timings = dict()
+    extractStart = time.perf_counter()
+    
+    def record_chunk(pid,busy,entries,stages):
+        # accumulate the number of files, busy time and stage timings of each
+        # worker
+        files,total = workers.get(pid,(0,0.0))
+        workers[pid] = (files+len(entries),total+busy)
+        StageTimer.merge(timings.setdefault(pid,dict()),stages)
+    
+    if streaming:
+        # Append entries as they complete, in batches of checkpointSize
+        with open(csvFile,'a') as out, open(checkpointFile,'a') as checkpoint:
+            # Entries found in the cache first
+            batch = [entry for entry in cached.values() if entry[0] not in done]
+            for start in range(0,len(batch),checkpointSize):
+                write_batch(out,checkpoint,batch[start:start+checkpointSize])
+            batch = []
+            for pid,busy,entries,stages in p.imap_unordered(extract_chunk,chunks):
+                record_chunk(pid,busy,entries,stages)
+                batch.extend([(name,features,join_label(Labels,name)) 
+                              for name,features in entries if name not in done])
+                if len(batch) >= checkpointSize:
+                    write_batch(out,checkpoint,batch)
+                    cache_entries(batch)
+                    batch = []
+            write_batch(out,checkpoint,batch)
+            cache_entries(batch)
+        elapsed = time.perf_counter()-extractStart
+        if outputFormat == 'store':
+            print('Creating',outFile)
+            FeatureStore.csvToStore(csvFile,outFile)
+    else:
+        entries = []
+        for pid,busy,chunkEntries,stages in p.imap_unordered(extract_chunk,chunks):
+            record_chunk(pid,busy,chunkEntries,stages)
+            entries.extend([(name,features,join_label(Labels,name))
+                            for name,features in chunkEntries])
+        elapsed = time.perf_counter()-extractStart
+        cache_entries(entries)
+        
+        # Merge extracted and cached entries in file order
+        extracted = dict((entry[0],entry) for entry in entries)
+        entries = [cached[filename] if filename in cached 
+                   else extracted[os.path.basename(filename)] for filename in filenames]
+        filenames_base,feature_matrix,label_vector = zip(*entries)
+
+        # Create Outfile 
+        # Inform User
+        print ('Creating',outFile)
+        if outputFormat == 'store':
+            FeatureStore.writeStore(FeatureStore.fromEntries(feature_matrix,label_vector,
+                                    filenames_base,columns),outFile)
+        else:
+            #outFile = outFile+'_sr'+str(sr)+'x'+str(sr)+'.csv' 
+            FeaturesetTools.writeMe(np.rec.fromarrays(entry_columns(entries)),
+                                    outFile,header='# '+header)
+    
+    log_utilization(workers,elapsed)
+    if timingFile is not None and not workers:
+        # all entries cached or already done, keep the timings of the last
+        # run that extracted features
+        print('No features extracted, stage timings not written to',timingFile)
+    elif timingFile is not None:
+        print('Writing stage timings to',timingFile)
+        StageTimer.writeTimings(timingFile,timings)
+    if cacheFile is not None:
+        print('Feature cache: %d hits, %d misses' % (cache.hits,cache.misses))
+        cache.close()
+    #Inform User
+    print('Process Complete')
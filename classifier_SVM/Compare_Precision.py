@@ -0,0 +1,75 @@
+#-------------------------------------------------------------------------------
+# Compare_Precision.py
+#
+# Tolerance report for the float32 compute mode of Build_Featureset.py. 
+# Extracts the 29 magnetic complexity features in float64 and float32 for a 
+# random sample of the dataset and reports, for each feature, the median and
+# maximum relative difference of the float32 value from the float64 value.
+#
+#  - Edit the lines under ## User Definitions to specify paths and other 
+#    parameters.
+#  - Relies on FeaturesetTools.py and general_code/DatasetManifest.py.
+#
+# Copyright 2022 Laura Boucheron, Jeremy Grajeda, Ellery Wuest
+# This file is part of AR-flares
+#
+# AR-flares is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# AR-flares is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# AR-flares. If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import sys
+import numpy as np
+import FeaturesetTools
+import FunctionsP3
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','general_code'))
+import DatasetManifest
+from multiprocessing import Pool
+
+## User Definitions
+# Modify the following to reflect the base directory of the dataset
+datasetDir = '/mnt/solar_flares/AR_Dataset/Lat60_Lon60_Nans0/' # dataset directory location
+# Specify whether the dataset is fits or png
+file_extension = 'fits' # fits or png
+# Specify the number of randomly sampled files to compare
+sampleSize = 200
+# Specify the output location of the report
+reportFile = 'float32_tolerance_report.txt'
+## End User Definitions
+
+def compare_precision(filename):
+    features = []
+    for dtype in (np.float64,np.float32):
+        Img = FeaturesetTools.loadMagnetogram(filename,dtype)
+        features.append(FeaturesetTools.concatVals(Img))
+    return features
+
+if __name__=='__main__':
+    filenames = DatasetManifest.listFiles(datasetDir,file_extension)
+    rng = np.random.default_rng(0)
+    sample = rng.choice(filenames,min(sampleSize,len(filenames)),replace=False)
+    
+    print('Comparing float32 and float64 features for',len(sample),'files')
+    with Pool() as p:
+        features = np.asarray(p.map(compare_precision,sample))
+    
+    # Relative difference, ignoring features that are zero in float64
+    double, single = features[:,0,:], features[:,1,:]
+    with np.errstate(divide='ignore',invalid='ignore'):
+        relDiff = np.absolute(single-double)/np.absolute(double)
+    relDiff[double == 0] = np.absolute(single-double)[double == 0]
+    
+    with open(reportFile,'w') as f:
+        f.write('float32 vs float64 features over '+str(len(sample))+' files\n')
+        f.write('%-26s %14s %14s\n' % ('Feature','median rel','max rel'))
+        for name,diff in zip(FunctionsP3.featureNames,relDiff.T):
+            f.write('%-26s %14.3e %14.3e\n' % (name,np.nanmedian(diff),np.nanmax(diff)))
+    print(open(reportFile).read())
@@ -0,0 +1,307 @@
+#-------------------------------------------------------------------------------
+# Distributed_Featureset.py
+#
+# Distributed mode of Build_Featureset.py: the feature extraction is shared by
+# worker processes on any number of hosts through a work queue directory on a
+# shared filesystem.
+#
+#  - The coordinator partitions the dataset manifest into shards of files:
+#       python Distributed_Featureset.py coordinate <queueDir> [--shard-size N]
+#  - Workers, started on any hosts that see queueDir and the dataset, claim
+#    shards through lease files created atomically (O_CREAT|O_EXCL), extract
+#    their features with a local pool of --workers processes and write one
+#    partial feature file per shard:
+#       python Distributed_Featureset.py work <queueDir> [--workers N]
+#                                        [--lease-timeout S] [--heartbeat S]
+#    A worker refreshes the modification time of its lease every --heartbeat
+#    seconds; a lease not refreshed for --lease-timeout seconds (crashed
+#    worker or host) is reclaimed by another worker. A shard is done when its
+#    partial file exists, which is written to a temporary file and renamed.
+#  - The merge step concatenates the partial files in shard order into outFile
+#    (in csv or FeatureStore format, as with Build_Featureset.py):
+#       python Distributed_Featureset.py merge <queueDir> [--out FILE]
+#       python Distributed_Featureset.py status <queueDir>
+#  - All settings (dataset, labels, features, precision...) are the ## User
+#    Definitions of Build_Featureset.py, which must be the same on all hosts;
+#    workers refuse a queue created with other settings or feature code. The
+#    feature cache of Build_Featureset.py is not used in distributed mode.
+#  - To try it locally, create a queue in a temporary directory and start
+#    several workers in the background before merging, e.g.:
+#       python Distributed_Featureset.py coordinate /tmp/queue --shard-size 50
+#       python Distributed_Featureset.py work /tmp/queue --workers 2 &
+#       python Distributed_Featureset.py work /tmp/queue --workers 2 &
+#       wait; python Distributed_Featureset.py merge /tmp/queue
+#
+# Copyright 2022 Laura Boucheron, Jeremy Grajeda, Ellery Wuest
+# This file is part of AR-flares
+#
+# AR-flares is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# AR-flares is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# AR-flares. If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import sys
+import csv
+import json
+import time
+import random
+import socket
+import argparse
+import threading
+from multiprocessing import Pool
+import Build_Featureset
+import FunctionsP3
+import FeatureStore
+import DatasetManifest
+
+def shardFile(queueDir,shard):
+    return os.path.join(queueDir,'shards','%05d.txt' % shard)
+
+def leaseFile(queueDir,shard):
+    return os.path.join(queueDir,'leases','%05d.lease' % shard)
+
+def partFile(queueDir,shard):
+    return os.path.join(queueDir,'parts','%05d.csv' % shard)
+
+def readQueue(queueDir):
+    with open(os.path.join(queueDir,'queue.json')) as f:
+        return json.load(f)
+
+def coordinate(queueDir,shardSize):
+    """
+    Creates the work queue in queueDir: one shard file per shardSize image
+    files of the dataset manifest (whole AR directories with batchByAR), in
+    file order so that the merged feature file is in file order. Each line of
+    a shard file is the full path and the size of an image file, the size
+    from the manifest estimates its extraction cost.
+    """
+
+    if os.path.exists(os.path.join(queueDir,'queue.json')):
+        sys.exit('A queue already exists in '+queueDir)
+    for sub in ('shards','leases','parts'):
+        os.makedirs(os.path.join(queueDir,sub),exist_ok=True)
+    manifest = DatasetManifest.buildManifest(Build_Featureset.datasetDir,
+                                             Build_Featureset.file_extension,
+                                             Build_Featureset.manifestFile)
+    filenames = [os.path.abspath(os.path.join(Build_Featureset.datasetDir,entry.path))
+                 for entry in manifest]
+    sizes = dict(zip(filenames,[entry.size for entry in manifest]))
+    if Build_Featureset.batchByAR:
+        groups = dict()
+        for filename in filenames:
+            groups.setdefault(os.path.dirname(filename),[]).append(filename)
+        groups = list(groups.values())
+    else:
+        groups = [[filename] for filename in filenames]
+    shards = [[]]
+    for group in groups:
+        if shards[-1] and len(shards[-1])+len(group) > shardSize:
+            shards.append([])
+        shards[-1].extend(group)
+    for shard,shardFiles in enumerate(shards):
+        with open(shardFile(queueDir,shard),'w') as f:
+            f.write(''.join([filename+'\t'+str(sizes[filename])+'\n' for filename in shardFiles]))
+    columns = FunctionsP3.featureNames if Build_Featureset.featureList is None \
+              else Build_Featureset.featureList
+    # queue.json is written last, workers wait for it
+    with open(os.path.join(queueDir,'queue.json.tmp'),'w') as f:
+        json.dump({'shards':len(shards),'files':len(filenames),
+                   'version':Build_Featureset.feature_version(),
+                   'columns':list(columns)},f)
+    os.replace(os.path.join(queueDir,'queue.json.tmp'),os.path.join(queueDir,'queue.json'))
+    print('Created',len(shards),'shards of',len(filenames),'files in',queueDir)
+
+def claim(queueDir,shard,token,leaseTimeout):
+    # Returns True if the lease of the shard was created by this worker,
+    # reclaiming it first if its owner stopped refreshing it
+    lease = leaseFile(queueDir,shard)
+    try:
+        fd = os.open(lease,os.O_CREAT|os.O_EXCL|os.O_WRONLY)
+    except FileExistsError:
+        try:
+            if time.time()-os.stat(lease).st_mtime < leaseTimeout:
+                return False
+            # move the stale lease aside, only one worker succeeds
+            os.rename(lease,lease+'.'+token)
+        except FileNotFoundError:
+            return False
+        stale = lease+'.'+token
+        if time.time()-os.stat(stale).st_mtime < leaseTimeout:
+            # the lease was refreshed meanwhile, put it back
+            try:
+                os.link(stale,lease)
+            except FileExistsError:
+                pass
+            os.remove(stale)
+            return False
+        os.remove(stale)
+        print('Reclaiming stale lease of shard',shard)
+        return claim(queueDir,shard,token,leaseTimeout)
+    os.write(fd,token.encode())
+    os.close(fd)
+    return True
+
+def ownsLease(queueDir,shard,token):
+    try:
+        with open(leaseFile(queueDir,shard)) as f:
+            return f.read() == token
+    except FileNotFoundError:
+        return False
+
+def heartbeat(queueDir,shard,token,interval,stop):
+    # refresh the lease until stop is set or the lease was reclaimed
+    while not stop.wait(interval):
+        if not ownsLease(queueDir,shard,token):
+            return
+        os.utime(leaseFile(queueDir,shard))
+
+def processShard(p,queueDir,shard,Labels):
+    # extract the features of the files of one shard, in shard file order
+    # file sizes recorded by the coordinator estimate the extraction cost, so
+    # the files are not stat'ed again on the shared filesystem
+    sizes = dict()
+    with open(shardFile(queueDir,shard)) as f:
+        for line in f.read().splitlines():
+            filename,size = line.rsplit('\t',1)
+            sizes[filename] = int(size)
+    filenames = list(sizes)
+    if Build_Featureset.batchByAR:
+        groups = dict()
+        for filename in filenames:
+            groups.setdefault(os.path.dirname(filename),[]).append(filename)
+        tasks = list(groups.values())
+        costs = [sum([sizes[filename] for filename in task]) for task in tasks]
+    else:
+        tasks = filenames
+        costs = [sizes[filename] for filename in tasks]
+    extracted = dict()
+    for pid,busy,entries,stages in p.imap_unordered(Build_Featureset.extract_chunk,
+                                             Build_Featureset.schedule(tasks,costs)):
+        extracted.update(entries)
+    return [(os.path.basename(filename),extracted[os.path.basename(filename)],
+             Build_Featureset.join_label(Labels,filename)) for filename in filenames]
+
+def work(queueDir,numWorkers,leaseTimeout,heartbeatInterval):
+    """
+    Claims and processes shards of the queue in queueDir until all shards are
+    done, with a local pool of numWorkers processes.
+    """
+
+    while not os.path.exists(os.path.join(queueDir,'queue.json')):
+        time.sleep(1)
+    queue = readQueue(queueDir)
+    if queue['version'] != Build_Featureset.feature_version():
+        sys.exit('The queue was created with other settings or feature code')
+    token = '%s:%d:%d' % (socket.gethostname(),os.getpid(),random.getrandbits(32))
+    with open(Build_Featureset.labelFile) as f:
+        Labels = dict(csv.reader(f,delimiter = ','))
+    Build_Featureset.numWorkers = numWorkers
+    p = Pool(numWorkers)
+    done = 0
+    while True:
+        pending = [shard for shard in range(queue['shards'])
+                   if not os.path.exists(partFile(queueDir,shard))]
+        if not pending:
+            break
+        # start at a random shard to limit contention between workers
+        start = random.randrange(len(pending))
+        shard = next((shard for shard in pending[start:]+pending[:start]
+                      if claim(queueDir,shard,token,leaseTimeout)),None)
+        if shard is None:
+            # all pending shards are leased, wait for them or for stale leases
+            time.sleep(heartbeatInterval)
+            continue
+        if os.path.exists(partFile(queueDir,shard)):
+            # done by another worker, which removed its lease, since pending
+            # was listed
+            os.remove(leaseFile(queueDir,shard))
+            continue
+        print('Worker',token,'processing shard',shard)
+        stop = threading.Event()
+        beat = threading.Thread(target=heartbeat,args=(queueDir,shard,token,
+                                                       heartbeatInterval,stop))
+        beat.start()
+        try:
+            entries = processShard(p,queueDir,shard,Labels)
+        finally:
+            stop.set()
+            beat.join()
+        part = partFile(queueDir,shard)
+        with open(part+'.'+token,'w') as f:
+            f.write(Build_Featureset.format_entries(entries))
+        if ownsLease(queueDir,shard,token):
+            os.replace(part+'.'+token,part)
+            os.remove(leaseFile(queueDir,shard))
+            done += 1
+        else:
+            # lease reclaimed by another worker while this one was stalled
+            os.remove(part+'.'+token)
+    p.close()
+    print('Worker',token,'done,',done,'shards processed')
+
+def status(queueDir):
+    # number of shards done, leased and waiting
+    queue = readQueue(queueDir)
+    done = sum([os.path.exists(partFile(queueDir,shard)) for shard in range(queue['shards'])])
+    leased = sum([os.path.exists(leaseFile(queueDir,shard)) and
+                  not os.path.exists(partFile(queueDir,shard)) for shard in range(queue['shards'])])
+    return '%d shards of %d files: %d done, %d leased, %d waiting' % \
+           (queue['shards'],queue['files'],done,leased,queue['shards']-done-leased)
+
+def merge(queueDir,outFile):
+    """
+    Concatenates the partial feature files of all shards into outFile, with
+    the commented header line of Build_Featureset.py.
+    """
+
+    queue = readQueue(queueDir)
+    missing = [shard for shard in range(queue['shards'])
+               if not os.path.exists(partFile(queueDir,shard))]
+    if missing:
+        sys.exit(str(len(missing))+' shards are not done: '+status(queueDir))
+    header = ','.join(queue['columns']+['Flare label','Flare class','Filename'])
+    if Build_Featureset.outputFormat == 'store':
+        csvFile = os.path.splitext(outFile)[0]+'.csv'
+    else:
+        csvFile = outFile
+    print('Creating',csvFile)
+    with open(csvFile,'w') as out:
+        out.write('# '+header+'\n')
+        for shard in range(queue['shards']):
+            with open(partFile(queueDir,shard)) as f:
+                out.write(f.read())
+    if Build_Featureset.outputFormat == 'store':
+        print('Creating',outFile)
+        FeatureStore.csvToStore(csvFile,outFile)
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Distributed feature extraction')
+    parser.add_argument('command',choices=['coordinate','work','merge','status'])
+    parser.add_argument('queueDir')
+    parser.add_argument('--shard-size',type=int,default=500,
+                        help='number of image files per shard')
+    parser.add_argument('--workers',type=int,default=Build_Featureset.numWorkers,
+                        help='number of local worker processes')
+    parser.add_argument('--lease-timeout',type=float,default=600,
+                        help='seconds without heartbeat before a lease is reclaimed')
+    parser.add_argument('--heartbeat',type=float,default=30,
+                        help='seconds between lease refreshes')
+    parser.add_argument('--out',default=Build_Featureset.outFile,
+                        help='merged feature file')
+    args = parser.parse_args()
+
+    if args.command == 'coordinate':
+        coordinate(args.queueDir,args.shard_size)
+    elif args.command == 'work':
+        work(args.queueDir,args.workers,args.lease_timeout,args.heartbeat)
+    elif args.command == 'merge':
+        merge(args.queueDir,args.out)
+    print(status(args.queueDir))
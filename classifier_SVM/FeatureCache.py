@@ -0,0 +1,196 @@
+#-------------------------------------------------------------------------------
+# FeatureCache.py
+#
+# Persistent on-disk cache of extracted feature vectors, used by 
+# Build_Featureset.py so that a rebuild only extracts features for new or 
+# changed image files. 
+#
+#  - Entries are keyed by the image file (either its path, size and 
+#    modification time, or a hash of its contents) and by the feature code 
+#    version, a hash of the sources that compute the features 
+#    (FunctionsP3.py, FeaturesetTools.py and general_code/MagnetogramReader.py)
+#    together with the extraction settings of the run. Editing any of them or
+#    changing the settings therefore never reuses stale features.
+#  - Labels are not cached; they are re-joined on every run.
+#  - Run as a script to show cache statistics or prune the cache:
+#       python FeatureCache.py stats <cacheFile>
+#       python FeatureCache.py prune <cacheFile> [--keep-version VERSION]
+#                                                [--older-than DAYS]
+#                                                [--missing-files]
+#
+# Copyright 2022 Laura Boucheron, Jeremy Grajeda, Ellery Wuest
+# This file is part of AR-flares
+#
+# AR-flares is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# AR-flares is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# AR-flares. If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import sys
+import time
+import hashlib
+import sqlite3
+import argparse
+import numpy as np
+
+# Sources of the feature values: the feature functions, the image loading 
+# and feature concatenation, and the fits reader (scaling, BLANK, png offset)
+featureSources = ['FunctionsP3.py','FeaturesetTools.py',
+                  os.path.join('..','general_code','MagnetogramReader.py')]
+
+def featureVersion(settings):
+    """
+    Returns the feature code version: a hash of the featureSources and of the
+    extraction settings (any repr-able object, e.g. a dict of the user 
+    definitions that change the extracted values).
+    """
+    
+    directory = os.path.dirname(os.path.abspath(__file__))
+    h = hashlib.sha1()
+    for source in featureSources:
+        with open(os.path.join(directory,source),'rb') as f:
+            h.update(f.read())
+    h.update(repr(settings).encode())
+    return h.hexdigest()[:16]
+
+def fileKey(filename,mode='stat'):
+    """
+    Returns the cache key of an image file. mode='stat' uses the absolute 
+    path, size and modification time (no file reads); mode='content' uses a 
+    hash of the file contents, so renamed or copied files are still found.
+    """
+    
+    if mode == 'content':
+        h = hashlib.sha1()
+        with open(filename,'rb') as f:
+            for block in iter(lambda: f.read(1<<20),b''):
+                h.update(block)
+        return 'sha1:'+h.hexdigest()
+    stat = os.stat(filename)
+    return 'stat:%s:%d:%d' % (os.path.abspath(filename),stat.st_size,stat.st_mtime_ns)
+
+class FeatureCache:
+    """
+    Cache of feature vectors for one feature code version, stored in a 
+    sqlite database. Intended to be used from a single process (the parent
+    of the extraction pool).
+    """
+    
+    def __init__(self,cacheFile,version):
+        self.cacheFile = cacheFile
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+        self.db = sqlite3.connect(cacheFile)
+        self.db.execute('CREATE TABLE IF NOT EXISTS features ('
+                        'key TEXT, version TEXT, filename TEXT, '
+                        'features BLOB, accessed REAL, '
+                        'PRIMARY KEY (key, version))')
+    
+    def lookup(self,keys):
+        """
+        Returns a dict mapping each of the keys found in the cache to its 
+        feature vector.
+        """
+        
+        found = dict()
+        keys = list(keys)
+        for start in range(0,len(keys),500):
+            chunk = keys[start:start+500]
+            rows = self.db.execute('SELECT key, features FROM features WHERE version = ? '
+                                   'AND key IN (%s)' % ','.join('?'*len(chunk)),
+                                   [self.version]+chunk)
+            for key,blob in rows:
+                found[key] = np.frombuffer(blob,dtype=float)
+        self.db.executemany('UPDATE features SET accessed = ? WHERE key = ? AND version = ?',
+                            [(time.time(),key,self.version) for key in found])
+        self.db.commit()
+        self.hits += len(found)
+        self.misses += len(set(keys))-len(found)
+        return found
+    
+    def store(self,entries):
+        """
+        Stores an iterable of (key, filename, features) entries.
+        """
+        
+        now = time.time()
+        self.db.executemany('INSERT OR REPLACE INTO features VALUES (?,?,?,?,?)',
+                            [(key,self.version,filename,
+                              np.asarray(features,dtype=float).tobytes(),now)
+                             for key,filename,features in entries])
+        self.db.commit()
+    
+    def close(self):
+        self.db.close()
+
+def cacheStats(cacheFile):
+    """
+    Returns a printable summary of the cache: file size and the number of 
+    entries and last access time for each feature code version.
+    """
+    
+    db = sqlite3.connect(cacheFile)
+    lines = [cacheFile+': %.1f MB' % (os.path.getsize(cacheFile)/2.**20)]
+    rows = db.execute('SELECT version, COUNT(*), MAX(accessed) FROM features '
+                      'GROUP BY version ORDER BY MAX(accessed) DESC')
+    for version,count,accessed in rows:
+        lines.append('  version %s: %d entries, last used %s' % 
+                     (version,count,time.strftime('%Y-%m-%d %H:%M',time.localtime(accessed))))
+    db.close()
+    return '\n'.join(lines)
+
+def pruneCache(cacheFile,keepVersion=None,olderThan=None,missingFiles=False):
+    """
+    Removes entries from the cache and returns the number removed. Entries 
+    are removed if keepVersion is given and they belong to another version, 
+    if olderThan (days) is given and they were not used more recently, or if 
+    missingFiles is set and their image file no longer exists.
+    """
+    
+    db = sqlite3.connect(cacheFile)
+    removed = 0
+    if keepVersion is not None:
+        removed += db.execute('DELETE FROM features WHERE version != ?',
+                              (keepVersion,)).rowcount
+    if olderThan is not None:
+        removed += db.execute('DELETE FROM features WHERE accessed < ?',
+                              (time.time()-86400.*olderThan,)).rowcount
+    if missingFiles:
+        missing = [(filename,) for (filename,) in 
+                   db.execute('SELECT DISTINCT filename FROM features')
+                   if not os.path.exists(filename)]
+        removed += db.executemany('DELETE FROM features WHERE filename = ?',
+                                  missing).rowcount
+    db.commit()
+    db.execute('VACUUM')
+    db.close()
+    return removed
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Feature cache statistics and pruning')
+    parser.add_argument('command',choices=['stats','prune'])
+    parser.add_argument('cacheFile')
+    parser.add_argument('--keep-version',default=None,
+                        help='remove entries of all other feature code versions')
+    parser.add_argument('--older-than',type=float,default=None,
+                        help='remove entries not used in this many days')
+    parser.add_argument('--missing-files',action='store_true',
+                        help='remove entries whose image file no longer exists')
+    args = parser.parse_args()
+    
+    if not os.path.exists(args.cacheFile):
+        sys.exit('Cache file '+args.cacheFile+' not found')
+    if args.command == 'prune':
+        removed = pruneCache(args.cacheFile,args.keep_version,args.older_than,
+                             args.missing_files)
+        print('Removed',removed,'entries')
+    print(cacheStats(args.cacheFile))
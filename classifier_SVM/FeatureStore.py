@@ -0,0 +1,200 @@
+#-------------------------------------------------------------------------------
+# FeatureStore.py
+#
+# Binary columnar feature store, an alternative to the csv feature files 
+# written by Build_Featureset.py and FeaturesetTools.createARBasedSets. A 
+# store is a directory containing:
+#     features.npy   - float64 feature matrix, one row per image
+#     label.npy      - int8 classification label (1 flare, 0 no flare, -1 
+#                      for images without a label)
+#     regression.npy - int32 regression label (flare class), as an index 
+#                      into the regressionLabels list in meta.json (-1 for
+#                      images without a label)
+#     ar.npy         - int32 NOAA active region number
+#     names.npy      - filenames, as fixed width ASCII strings
+#     meta.json      - feature (column) names and the regressionLabels list
+# All arrays are read with memory mapping, so opening a store is immediate 
+# and only the columns used are read from disk.
+#
+#  - Run as a script to convert between formats:
+#       python FeatureStore.py tostore <csvFile> <storeDir>
+#       python FeatureStore.py tocsv <storeDir> <csvFile>
+#
+# Copyright 2022 Laura Boucheron, Jeremy Grajeda, Ellery Wuest
+# This file is part of AR-flares
+#
+# AR-flares is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# AR-flares is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# AR-flares. If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import sys
+import csv
+import json
+import numpy as np
+
+class FeatureStore:
+    """
+    Columns of a feature store. Attributes features, label, regression, ar
+    and names are numpy arrays (memory mapped when read from disk); columns 
+    lists the feature names and regressionLabels the flare classes indexed 
+    by regression.
+    """
+    
+    def __init__(self,features,label,regression,regressionLabels,ar,names,
+                 columns=None):
+        self.features = features
+        self.label = label
+        self.regression = regression
+        self.regressionLabels = list(regressionLabels)
+        self.ar = ar
+        self.names = names
+        if columns is None:
+            columns = ['Feature '+str(i) for i in range(np.shape(features)[1])]
+        self.columns = list(columns)
+    
+    def __len__(self):
+        return len(self.features)
+    
+    def subset(self,rows):
+        """
+        Returns a new (in memory) FeatureStore with the given rows.
+        """
+        
+        return FeatureStore(self.features[rows],self.label[rows],
+                            self.regression[rows],self.regressionLabels,
+                            self.ar[rows],self.names[rows],self.columns)
+    
+    def regressionStrings(self):
+        """
+        Returns the regression label of each row as a string ('NaN' for 
+        rows without a label).
+        """
+        
+        labels = np.asarray(self.regressionLabels+['NaN'])
+        return labels[np.asarray(self.regression)]
+
+def isStore(path):
+    """
+    Returns True if path is a feature store directory.
+    """
+    
+    return os.path.isfile(os.path.join(path,'meta.json'))
+
+def fromEntries(features,labels,names,columns=None):
+    """
+    Builds a FeatureStore from feature vectors, label strings as produced by
+    Build_Featureset.py ('0,0', '1,M1.0' or 'NaN') and filenames of the form 
+    ARNUM_hmi...
+    """
+    
+    label = np.full(len(labels),-1,dtype=np.int8)
+    regression = np.full(len(labels),-1,dtype=np.int32)
+    regressionLabels = []
+    codes = dict()
+    for i,entry in enumerate(labels):
+        if entry != 'NaN':
+            classLabel,flareClass = entry.split(',')
+            label[i] = int(classLabel)
+            if flareClass not in codes:
+                codes[flareClass] = len(regressionLabels)
+                regressionLabels.append(flareClass)
+            regression[i] = codes[flareClass]
+    ar = np.array([int(float(name.split('_h')[0])) for name in names],dtype=np.int32)
+    names = np.array(names,dtype=bytes)
+    features = np.asarray(features,dtype=float).reshape(len(names),-1)
+    return FeatureStore(features,label,regression,regressionLabels,ar,names,columns)
+
+def writeStore(store,path):
+    """
+    Writes a FeatureStore to the directory path.
+    """
+    
+    if not os.path.exists(path):
+        os.makedirs(path)
+    np.save(os.path.join(path,'features.npy'),np.asarray(store.features,dtype=float))
+    np.save(os.path.join(path,'label.npy'),np.asarray(store.label,dtype=np.int8))
+    np.save(os.path.join(path,'regression.npy'),np.asarray(store.regression,dtype=np.int32))
+    np.save(os.path.join(path,'ar.npy'),np.asarray(store.ar,dtype=np.int32))
+    np.save(os.path.join(path,'names.npy'),np.asarray(store.names,dtype=bytes))
+    # meta.json is written last, so that isStore is only true once complete
+    with open(os.path.join(path,'meta.json'),'w') as f:
+        json.dump({'columns':store.columns,
+                   'regressionLabels':store.regressionLabels},f)
+
+def readStore(path,mmap=True):
+    """
+    Reads the FeatureStore in directory path, with memory mapped columns 
+    unless mmap is False.
+    """
+    
+    mode = 'r' if mmap else None
+    with open(os.path.join(path,'meta.json')) as f:
+        meta = json.load(f)
+    load = lambda name: np.load(os.path.join(path,name+'.npy'),mmap_mode=mode)
+    return FeatureStore(load('features'),load('label'),load('regression'),
+                        meta['regressionLabels'],load('ar'),load('names'),
+                        meta['columns'])
+
+def csvToStore(csvFile,path):
+    """
+    Converts a csv feature file (as written by Build_Featureset.py) into a 
+    feature store. The column names are taken from the commented header 
+    line, if present.
+    """
+    
+    columns = None
+    features = []
+    labels = []
+    names = []
+    with open(csvFile) as f:
+        for row in csv.reader(f,delimiter = ','):
+            if row[0].startswith('#'):
+                columns = row[:-3]
+                columns[0] = columns[0].lstrip('# ')
+                continue
+            # the label is two columns, or a single 'NaN' for unlabeled images
+            if row[-2] == 'NaN':
+                numFeatures = len(row)-2
+                labels.append('NaN')
+            else:
+                numFeatures = len(row)-3
+                labels.append(row[-3]+','+row[-2])
+            features.append([float(value) for value in row[:numFeatures]])
+            names.append(row[-1])
+    writeStore(fromEntries(features,labels,names,columns),path)
+
+def storeToCsv(path,csvFile):
+    """
+    Exports a feature store to a csv feature file in the format written by 
+    Build_Featureset.py.
+    """
+    
+    store = readStore(path)
+    regression = store.regressionStrings()
+    with open(csvFile,'w') as f:
+        f.write('# '+','.join(store.columns+['Flare label','Flare class','Filename'])+'\n')
+        for i in range(len(store)):
+            if store.label[i] < 0:
+                label = 'NaN'
+            else:
+                label = str(store.label[i])+','+regression[i]
+            f.write(','.join([str(value) for value in store.features[i].tolist()]
+                             +[label,store.names[i].decode()])+'\n')
+
+if __name__=='__main__':
+    if len(sys.argv) != 4 or sys.argv[1] not in ('tostore','tocsv'):
+        sys.exit('usage: python FeatureStore.py tostore <csvFile> <storeDir>\n'
+                 '       python FeatureStore.py tocsv <storeDir> <csvFile>')
+    if sys.argv[1] == 'tostore':
+        csvToStore(sys.argv[2],sys.argv[3])
+    else:
+        storeToCsv(sys.argv[2],sys.argv[3])
@@ -3,7 +3,7 @@
 #
 # Helper functions for feature extraction. 
 #
-#  - Relies on FunctionsP3.py
+#  - Relies on FunctionsP3.py and general_code/MagnetogramReader.py
 #
 # References:
 # [1] L. E. Boucheron, T. Vincent, J. A. Grajeda, and E. Wuest, "Solar Active 
@@ -29,11 +29,32 @@
 # Import Libraries and tools
 import numpy as np
 import FunctionsP3
-import copy
-import csv
+import FeatureStore
+import StageTimer
+import hashlib
 import os
+import sys
+import imageio
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','general_code'))
+import MagnetogramReader
 
-def concatVals(image):
+def loadMagnetogram(filename,dtype=float):
+    """
+    Loads a magnetogram from a fits file (HDU 1) or a png file (offset so 
+    that zero flux is at zero) and converts it once to a native-endian array
+    of the requested dtype (float or np.float32), so that no further 
+    conversions are needed in the feature extraction. Fits images are 
+    memory-mapped when possible (see MagnetogramReader.py).
+    """
+    
+    if filename.endswith('.fits'):
+        Img = MagnetogramReader.readMagnetogram(filename,dtype)
+    else:
+        Img = np.asarray(imageio.imread(filename),dtype=dtype)
+        Img = Img-128 # offset so that zero flux is at zero
+    return Img
+
+def concatVals(image,features=None):
     """
     For each image returns, in order:
         GRADIENT FEATURES:
@@ -51,62 +72,154 @@ def concatVals(image):
         FLUX FEATURES:
             Total postive flux, Total negative flux, Total signed flux, Total
             unsigned flux
+    
+    If a list of feature names (from FunctionsP3.featureNames) is given as
+    features, only the feature groups and intermediate products needed for 
+    those features are computed, and the features are returned in the order 
+    they are listed.
+    
+    image may also be a FunctionsP3.FeatureContext, e.g., to inspect the
+    intermediate products after the features are computed.
     """
     
+    # Share the gradient, smoothed field and contours between feature groups
+    context = FunctionsP3.getContext(image)
+    
+    # Compute the intermediate products first so each stage is timed alone
+    # (see StageTimer.py)
+    for name in sorted(FunctionsP3.requiredIntermediates(features),
+                       key=list(FunctionsP3.intermediateDependencies).index):
+        started = StageTimer.start()
+        getattr(context,name)
+        StageTimer.record(name,started)
+    
     # Generate fetures
-    G   = FunctionsP3.Gradfeat(image)
-    NL  = FunctionsP3.NLfeat(image)
-    wav = FunctionsP3.wavel(image)
-    F   = FunctionsP3.fluxValues(image)
+    values = dict()
+    for group,function,intermediates,perImage,names in FunctionsP3.selectGroups(features):
+        started = StageTimer.start()
+        values.update(zip(names,function(context)))
+        StageTimer.record(group,started)
     
     # Concatenate and return results
-    return np.concatenate((G,NL,wav,F))
+    if features is None:
+        features = FunctionsP3.featureNames
+    return np.array([values[name] for name in features],dtype=float)
+
+def concatValsStack(images,features=None):
+    """
+    Batched version of concatVals for a stack of same-sized images (e.g., all
+    frames of one active region), given as an array of shape (N, H, W).
+    Returns an (N, 29) array with the features of each image in the order
+    given by concatVals, or an (N, len(features)) array if a list of feature
+    names is given as features. The gradient, wavelet and flux features are 
+    computed over the whole stack at once; only the neutral line features 
+    (contour tracing) are computed image by image.
+    
+    images may also be a FunctionsP3.FeatureContext of the stack, whose 
+    frame(n) then holds the intermediate products of image n.
+    """
+    
+    if not isinstance(images,FunctionsP3.FeatureContext):
+        images = FunctionsP3.FeatureContext(np.asarray(images))
+    context = images
+    images = context.image
+    
+    # Stack-wide intermediate products needed by the requested features
+    # (stages timed per stack, see StageTimer.py)
+    for name in FunctionsP3.requiredIntermediates(features):
+        if name != 'contours':
+            started = StageTimer.start()
+            getattr(context,name)
+            StageTimer.record(name,started)
+    frames = None
+    
+    # Generate features
+    values = dict()
+    for group,function,intermediates,perImage,names in FunctionsP3.selectGroups(features):
+        if perImage:
+            if frames is None:
+                frames = [context.frame(n) for n in range(len(images))]
+                if 'contours' in FunctionsP3.requiredIntermediates(features):
+                    for frame in frames:
+                        started = StageTimer.start()
+                        frame.contours
+                        StageTimer.record('contours',started)
+            started = StageTimer.start()
+            result = np.array([function(frame) for frame in frames])
+            values.update(zip(names,result.reshape(len(images),len(names)).T))
+        else:
+            started = StageTimer.start()
+            values.update(zip(names,function(context)))
+        StageTimer.record(group,started)
+    
+    # Concatenate and return results
+    if features is None:
+        features = FunctionsP3.featureNames
+    return np.column_stack([values[name] for name in features]).astype(float)
+
+def equalizationFactors(features):
+    """
+    Returns the equalization factors/weights of a 2D float array of features
+    (one column per feature) as an (F, 2) array: the minimum of each column
+    and the maximum of each column once shifted by that minimum. Computed in
+    one vectorized pass over the columns.
+    """
+    
+    features = np.asarray(features,dtype=float)
+    eqFactors = np.zeros([features.shape[1],2])
+    eqFactors[:,0] = np.amin(features,axis=0)
+    # max(x-min) equals max(x)-min, rounding is monotonic
+    eqFactors[:,1] = np.amax(features,axis=0)-eqFactors[:,0]
+    return eqFactors
+
+def equalize(features,eqFactors,out=None):
+    """
+    Equalizes a 2D float array of features with the equalization factors of
+    equalizationFactors, i.e., shifts each column by its minimum and scales it
+    by its shifted maximum (unless zero), as equalizeNewData. The result is 
+    written to out if given (a preallocated float array, or features itself to
+    equalize in place) and returned.
+    """
+    
+    eqFactors = np.asarray(eqFactors,dtype=float)[:np.shape(features)[1]]
+    scale = np.where(eqFactors[:,1] != 0,eqFactors[:,1],1.)
+    out = np.subtract(features,eqFactors[:,0],out=out)
+    return np.divide(out,scale,out=out)
+
+def floatFields(Data,limit):
+    # names of the float fields of a structured array (e.g., from 
+    # np.genfromtxt with dtype=None) among its first limit fields
+    return [name for name in Data.dtype.names[:limit] if Data.dtype[name].kind == 'f']
 
 def equalizeTrainData(trainData,limit=None):
     """
     Function equalizes the data provided and outputs the result and the max 
     and min for each category equalized.
-    """
     
-    # Make sure the original data is left untouched
-    Data = copy.deepcopy(trainData)
+    trainData is a 2D float array, or a structured array (e.g., the feature
+    file loaded with np.genfromtxt and dtype=None) whose float fields are
+    equalized; other fields (labels and names) get factors of 0 and 1.
+    """
     
     # Set limit
     if limit is None:
-        limit = len(Data[0])
-    
-    # Find Data Limits
-    dataLength = len(Data)
+        limit = len(trainData[0])
     
     # Create object to hold the equalization factors/weights
     eqFactors = np.zeros([limit,2])
+    eqFactors[:,1] = 1
     
-    # For each Feature...
-    for i in range(limit):
-        
-        # If it is a feature, and not a label
-        if isinstance(Data[0][i],float):
-            featureValues = np.zeros(dataLength)
-            
-            # Figure out the min
-            for j in range(dataLength):
-                featureValues[j] = Data[j][i] * 1.0
-            eqFactors[i,0] = np.amin(featureValues)
-             
-            # Offset based on that min and find the new max
-            for j in range(dataLength):
-                Data[j][i] = Data[j][i] - eqFactors[i,0]
-                featureValues[j] = Data[j][i] * 1.0
-            eqFactors[i,1] = np.amax(featureValues)
-            
-            # Equalize
-            if eqFactors[i,1] != 0:
-                for j in range(dataLength):
-                    Data[j][i] = Data[j][i] / eqFactors[i,1]
-                    
-        # Otherwise, make sure that the eqFactor doesn't affect other processes
-        else:
-            eqFactors[i,1] = 1
+    # Equalize a copy, so the original data is left untouched
+    if isinstance(trainData,np.ndarray) and trainData.dtype.names:
+        Data = trainData.copy()
+        for name in floatFields(Data,limit):
+            i = Data.dtype.names.index(name)
+            eqFactors[i] = equalizationFactors(Data[name][:,None])[0]
+            equalize(Data[name][:,None],eqFactors[i:i+1],out=Data[name][:,None])
+    else:
+        Data = np.array(trainData,dtype=float)
+        eqFactors = equalizationFactors(Data[:,:limit])
+        equalize(Data[:,:limit],eqFactors,out=Data[:,:limit])
     
     # Return the equalized data and the equalization factors/weights
     return Data, eqFactors
@@ -117,84 +230,103 @@ def equalizeNewData(newData,eqFactors):
     serve as the minimum value and adjusted maximum value.
     """
     
-    # Make sure the original data is left untouched
-    Data = copy.deepcopy(newData)
-    
-    #ensure data is an array
-    try:
-        len(Data)
-    except:
-        Data = [Data]
-    
-    # Equalize
-    for i in range(len(eqFactors)):
-        for j in range(len(Data)):
-            if isinstance(Data[j][i],float):
-                Data[j][i] = float(Data[j][i]) - eqFactors[i,0] # Shift by min
-                if eqFactors[i,1] != 0:
-                    Data[j][i] = float(Data[j][i]) / float(eqFactors[i,1]) # Scale based on max
+    # Equalize a copy, so the original data is left untouched
+    if isinstance(newData,np.ndarray) and newData.dtype.names:
+        Data = newData.copy()
+        for name in floatFields(Data,len(eqFactors)):
+            i = Data.dtype.names.index(name)
+            equalize(Data[name][:,None],eqFactors[i:i+1],out=Data[name][:,None])
+    else:
+        #ensure data is a 2D array
+        Data = np.array(newData,dtype=float,ndmin=2)
+        limit = min(len(eqFactors),Data.shape[1])
+        equalize(Data[:,:limit],eqFactors,out=Data[:,:limit])
     
     # Return the equalized data
     return Data
 
-def listAllAR(masterFile):
+class ARIndex:
     """
-    Function generates and returns a list of all of the active regions in a 
-    featureset
+    Index of the active regions of a featureset, built in a single pass over
+    its AR column. Attributes ar (AR number of each row) and ARs (AR numbers
+    in order of first appearance) are numpy arrays; rows of one AR are given
+    as a slice if contiguous, or as an array of row indexes otherwise.
     """
     
-    # Read masterFile
-    with open(masterFile)as f:
-        csvData = csv.reader(f,delimiter = ',')
-        features = []
-        for datum in csvData:
-            features.append(datum)
+    def __init__(self,ar):
+        self.ar = np.asarray(ar,dtype=int)
+        ARs,first,self.codes = np.unique(self.ar,return_index=True,return_inverse=True)
+        self.ARs = ARs[np.argsort(first)]
+        self.code = dict((AR,n) for n,AR in enumerate(ARs.tolist()))
+        # Rows of each AR, grouped by a stable sort of the AR codes
+        order = np.argsort(self.codes,kind='stable')
+        stops = np.cumsum(np.bincount(self.codes,minlength=len(ARs)))
+        self.ranges = dict()
+        for AR,start,stop in zip(ARs.tolist(),stops-np.bincount(self.codes,minlength=len(ARs)),stops):
+            rows = order[start:stop]
+            if rows[-1]-rows[0]+1 == len(rows):
+                self.ranges[AR] = slice(int(rows[0]),int(rows[-1])+1)
+            else:
+                self.ranges[AR] = rows
+    
+    @classmethod
+    def fromLines(cls,lines):
+        # AR numbers from the filename (last column) of the lines of a csv 
+        # featureset, skipping the commented header line
+        return cls([int(float(line.rsplit(',',1)[-1].split('_h')[0]))
+                    for line in lines if line.strip() and not line.startswith('#')])
+    
+    @classmethod
+    def fromNames(cls,names):
+        # AR numbers from the filenames (ARNUM_hmi...) of a featureset
+        return cls([int(float(name.split('_h')[0])) for name in names])
+    
+    @classmethod
+    def fromFile(cls,masterFile):
+        """
+        Returns the ARIndex of a featureset (csv file or FeatureStore
+        directory).
+        """
         
-    # Generate list of active regions
-    ARList = []
-    i = True
-    for feature in features:
-        # Find name of Active Region
-        name = feature[-1].split('_h')[0]
-        name = int(float(name)) # for some reason you can't go from string to int
+        if FeatureStore.isStore(masterFile):
+            return cls(FeatureStore.readStore(masterFile).ar)
+        with open(masterFile) as f:
+            return cls.fromLines(f)
+    
+    def rowsOf(self,AR):
+        # slice or array of the rows of one AR (empty if not in the index)
+        return self.ranges.get(int(AR),slice(0,0))
+    
+    def rows(self,ARList):
+        """
+        Returns the sorted row indexes of the given active regions, by array
+        membership of the AR code of each row (linear in the number of rows).
+        """
         
-        # Check to see if name already exists
-        if i:
-            ARList.append(int(name))
-            i = False
-        elif int(ARList[-1]) != name:
-            ARList.append(int(name))
+        selected = np.zeros(len(self.code)+1,dtype=bool)
+        for AR in np.atleast_1d(ARList).tolist():
+            selected[self.code.get(int(AR),len(self.code))] = True
+        selected[-1] = False
+        return np.flatnonzero(selected[self.codes])
+
+def listAllAR(masterFile):
+    """
+    Function generates and returns a list of all of the active regions in a 
+    featureset (csv file or FeatureStore directory), in order of first 
+    appearance (entries of an active region need not be contiguous, e.g. in a
+    streamed file)
+    """
     
-    # Return Results
-    return ARList
+    return ARIndex.fromFile(masterFile).ARs.tolist()
 
 def listEntries(masterFile,ARList):
     """
     Given a list of active regions and the filenmae of a featureset, this
     function generates a list of the indexes that corrispond to those regions
+    The featureset may be a csv file or a FeatureStore directory.
     """
     
-    # Read masterFile
-    with open(masterFile) as f:
-        csvData = csv.reader(f,delimiter = ',')
-        features = []
-        for datum in csvData:
-            features.append(datum)
-    
-    # Generate list of indexes
-    IndexList = []
-    for i in range(len(features)):
-        # Find name of active region
-        name = features[i][-1].split('_h')[0]
-        name = int(float(name)) #int(str) doesn't work
-        
-        # check to see if name is included in ARList
-        for entry in ARList:
-            if name == entry:
-                IndexList.append(i)
-                
-    # Return Results
-    return IndexList
+    return ARIndex.fromFile(masterFile).rows(ARList).tolist()
 
 def createARBasedSets(masterFile,trainData,testData,valadationData,weightData,
                       testARList,valadationARList,limit=None,
@@ -217,7 +349,9 @@ def createARBasedSets(masterFile,trainData,testData,valadationData,weightData,
     Parameters
     ----------
     masterFile : str
-        Path and name of file that contains the full dataset
+        Path and name of file that contains the full dataset. If masterFile 
+        is a FeatureStore directory, the Training, Test and Valadation Sets 
+        are written as FeatureStore directories as well
     trainData : str
         Path and name that will be giving to the Training Set
     testData : str
@@ -275,6 +409,16 @@ def createARBasedSets(masterFile,trainData,testData,valadationData,weightData,
         Default Value = 10%
     """
     
+    # Read masterFile once and index the rows of each active region
+    if FeatureStore.isStore(masterFile):
+        store = FeatureStore.readStore(masterFile)
+        index = ARIndex(store.ar)
+    else:
+        with open(masterFile) as f:
+            lines = f.readlines()
+        index = ARIndex.fromLines(lines)
+    ARListData = index.ARs.tolist()
+    
     # Generate list of active regions in Test Set
     if testArListExists and os.path.exists(testARList):
         testARListData = np.genfromtxt(testARList, dtype = int)
@@ -282,7 +426,6 @@ def createARBasedSets(masterFile,trainData,testData,valadationData,weightData,
         print('Creating a new test data split!!!')
         if testSize >= 1:
             testSize = testSize / 100.
-        ARListData = listAllAR(masterFile)
         testSize = np.ceil(testSize * len(ARListData))
         testRows = np.random.choice(len(ARListData),int(testSize),replace = False)
         testARListData = np.array(ARListData)[testRows]
@@ -298,15 +441,11 @@ def createARBasedSets(masterFile,trainData,testData,valadationData,weightData,
         print('Creating a new validation data split!!!')
         if valadationSize >= 1:
             valadationSize = valadationSize / 100.
-        ARListData = listAllAR(masterFile)
         valadationSize = np.ceil(valadationSize * len(ARListData))
         # Make sure that nothing in the testSet ends up in the ValadationSet
         Prob = 1./(len(ARListData) - len(testARListData))
-        Prob = np.ones(len(ARListData)) * Prob
-        for i in range(len(ARListData)):
-            for j in range(len(testARListData)):
-                if ARListData[i] == testARListData[j]:
-                    Prob[i] = 0
+        testARSet = set(np.atleast_1d(testARListData).tolist())
+        Prob = np.array([0. if AR in testARSet else Prob for AR in ARListData])
         # Generate Data
         valadationRows = np.random.choice(len(ARListData), int(valadationSize),
                                           replace = False, p = Prob)
@@ -315,12 +454,35 @@ def createARBasedSets(masterFile,trainData,testData,valadationData,weightData,
         np.savetxt(valadationARList,valadationARListData,delimiter = ',', fmt = '%i')        
         
     # Use AR Lists to create test and Valadation Rows
-    testRows = listEntries(masterFile,testARListData)
-    valRows  = listEntries(masterFile,valadationARListData)
-    allRows  = np.concatenate([testRows,valRows])
+    testRows = index.rows(testARListData)
+    valRows  = index.rows(valadationARListData)
+    allRows  = np.concatenate([testRows,valRows]).astype(int)
+    
+    # A FeatureStore masterFile gives FeatureStore sets
+    if FeatureStore.isStore(masterFile):
+        features = np.array(store.features)
+        
+        # Equlize Features
+        if weightDataExists and os.path.exists(weightData):
+            weights = np.genfromtxt(weightData,delimiter = ',', dtype = None)
+            features = equalizeNewData(features,weights[:features.shape[1]])
+        else:
+            features, weights = equalizeTrainData(features,limit = limit)
+            # Save list for next time
+            np.savetxt(weightData, weights, delimiter = ',', fmt = '%s')
+        store = FeatureStore.FeatureStore(features,store.label,store.regression,
+                                          store.regressionLabels,store.ar,
+                                          store.names,store.columns)
+        
+        # Make and save test_set, valadation_set and train_set
+        trainRows = np.setdiff1d(np.arange(len(store)),allRows)
+        FeatureStore.writeStore(store.subset(trainRows),trainData)
+        FeatureStore.writeStore(store.subset(testRows),testData)
+        FeatureStore.writeStore(store.subset(valRows),valadationData)
+        return
     
     # Get features
-    fullFeatureset = np.genfromtxt(masterFile,delimiter = ',', dtype = None,encoding=None)
+    fullFeatureset = np.genfromtxt(lines,delimiter = ',', dtype = None,encoding=None)
     
     # Equlize Features
     if weightDataExists and os.path.exists(weightData):
@@ -340,51 +502,231 @@ def createARBasedSets(masterFile,trainData,testData,valadationData,weightData,
     writeMe(train_set,trainData,correctName=True)
     writeMe(test_set,testData,correctName=True)
     writeMe(val_set,valadationData,correctName=True)
+
+def labelsFromLines(lines):
+    # classification label of each line of a csv featureset (-1 for 'NaN'
+    # labels of unlabeled images), skipping the commented header line
+    labels = []
+    for line in lines:
+        if not line.strip() or line.startswith('#'):
+            continue
+        fields = line.rstrip('\n').rsplit(',',3)
+        labels.append(-1 if fields[-2] == 'NaN' else int(float(fields[-3])))
+    return np.array(labels,dtype=int)
+
+def loadFeatureset(path,dtype=float):
+    """
+    Loads the features, classification labels and filenames of a featureset
+    (e.g., the train, test or val set written by createARBasedSets) in a
+    single pass and returns them as an (N, F) array of the given dtype
+    (float or np.float32), an int array (-1 for 'NaN' labels of unlabeled
+    images) and a str array. A FeatureStore directory is read from its
+    columns; a csv file is read once, its lines split from the right into
+    features, label and filename, and all feature values parsed at once.
+    """
+
+    if FeatureStore.isStore(path):
+        store = FeatureStore.readStore(path)
+        return (np.asarray(store.features,dtype=dtype),
+                np.asarray(store.label,dtype=int),
+                np.asarray(store.names).astype(str))
+
+    features = []
+    labels = []
+    names = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip() or line.startswith('#'):
+                continue
+            # features...,label,flare class,filename or features...,NaN,filename
+            head,flareClass,name = line.rstrip('\n').rsplit(',',2)
+            if flareClass == 'NaN':
+                labels.append(-1)
+            else:
+                head,label = head.rsplit(',',1)
+                labels.append(int(float(label)))
+            features.append(head)
+            names.append(name)
+
+    # Parse all feature values at once
+    if not names:
+        return np.zeros((0,0),dtype=dtype), np.zeros(0,dtype=int), np.zeros(0,dtype=str)
+    features = np.fromstring(','.join(features),dtype=float,sep=',')
+    features = features.reshape(len(names),-1).astype(dtype,copy=False)
+    return features, np.array(labels,dtype=int), np.array(names,dtype=str)
+
+def assignFolds(index,label,numFolds,seed=0,stratified=True):
+    """
+    Assigns each active region of an ARIndex to one of numFolds folds and
+    returns the fold of each row (-1 for unlabeled rows). Active regions are
+    taken in random order (given by seed) and largest first, each going to
+    the fold with the fewest rows so far, so that folds have similar sizes.
+    With stratified, flaring active regions (any row labeled 1) and
+    non-flaring ones are assigned separately, so that each fold gets a
+    similar share of flaring active regions.
+    """
+
+    label = np.asarray(label,dtype=int)
+    rows = np.bincount(index.codes,minlength=len(index.code))
+    flaring = np.zeros(len(index.code),dtype=bool)
+    flaring[index.codes[label == 1]] = True
+    strata = [flaring,~flaring] if stratified else [np.ones(len(flaring),dtype=bool)]
+
+    rng = np.random.RandomState(seed)
+    foldOfCode = np.zeros(len(index.code),dtype=int)
+    for stratum in strata:
+        codes = rng.permutation(np.flatnonzero(stratum))
+        codes = codes[np.argsort(-rows[codes],kind='stable')]
+        sizes = np.zeros(numFolds,dtype=int)
+        for code in codes.tolist():
+            fold = int(np.argmin(sizes))
+            foldOfCode[code] = fold
+            sizes[fold] += rows[code]
+    fold = foldOfCode[index.codes]
+    fold[label < 0] = -1
+    return fold
+
+def foldKey(masterFile,numFolds,seed,stratified):
+    # cache key of the folds of a featureset: the settings and the path, size
+    # and modification time of the csv file (or the label and AR columns of
+    # a FeatureStore)
+    if FeatureStore.isStore(masterFile):
+        files = [os.path.join(masterFile,'label.npy'),os.path.join(masterFile,'ar.npy')]
+    else:
+        files = [masterFile]
+    key = [numFolds,seed,bool(stratified)]
+    for filename in files:
+        stat = os.stat(filename)
+        key += [os.path.abspath(filename),stat.st_size,stat.st_mtime_ns]
+    return hashlib.sha1(repr(key).encode()).hexdigest()[:16]
+
+def createARFolds(masterFile,foldFile=None,numFolds=5,seed=0,stratified=True,
+                  label=None,names=None):
+    """
+    Generate cross-validation folds divided by Active Region.
+
+    Function splits the active regions of a featureset into numFolds
+    disjoint folds (see assignFolds) and returns, for each fold, the row
+    indexes of the training set (all other folds) and of the test set (the
+    fold), as index arrays into the full feature matrix, so that no copy of
+    the data is written.
+
+    Parameters
+    ----------
+    masterFile : str
+        Path and name of file that contains the full dataset (csv file or
+        FeatureStore directory)
+    foldFile : str
+        Path and name of a .npz file caching the fold of each row, keyed by
+        masterFile (path, size and modification time), numFolds, seed and
+        stratified. Folds found in it are reused, new folds are added to it.
+
+        Default Value = None (folds are not cached)
+    numFolds : int
+        Number of folds
+
+        Default Value = 5
+    seed : int
+        Seed of the random assignment of active regions to folds
+
+        Default Value = 0
+    stratified : bool
+        Assign flaring and non-flaring active regions to folds separately
+
+        Default Value = True
+    label, names : np.array
+        Classification label and filename of each row of masterFile, if 
+        already loaded (e.g., with loadFeatureset), so that masterFile is not
+        read again
+
+        Default Value = None (read from masterFile)
+    """
+
+    key = 'folds_'+foldKey(masterFile,numFolds,seed,stratified)
+    cached = dict()
+    if foldFile is not None and os.path.exists(foldFile):
+        with np.load(foldFile) as f:
+            cached = dict(f)
+    if key in cached:
+        fold = cached[key]
+    else:
+        if label is not None and names is not None:
+            index = ARIndex.fromNames(names)
+        elif FeatureStore.isStore(masterFile):
+            store = FeatureStore.readStore(masterFile)
+            index = ARIndex(store.ar)
+            label = store.label
+        else:
+            with open(masterFile) as f:
+                lines = f.readlines()
+            index = ARIndex.fromLines(lines)
+            label = labelsFromLines(lines)
+        fold = assignFolds(index,label,numFolds,seed,stratified)
+        if foldFile is not None:
+            # Save folds for next time
+            cached[key] = fold
+            np.savez(foldFile,**cached)
+
+    # Rows of the training and test set of each fold
+    return [(np.flatnonzero((fold >= 0) & (fold != n)),np.flatnonzero(fold == n))
+            for n in range(numFolds)]
+
+def formatColumns(columns,replaceLabel=False,precision=None):
+    """
+    Formats a block of rows given as a list of columns (1D arrays or lists of
+    floats, integers or strings) as csv lines, a column at a time. Floats are 
+    written as str() does (shortest representation that reads back exactly)
+    or, if precision is given, with that many significant digits. With 
+    replaceLabel, the second to last column is written as '1' for every 
+    value other than 0 or '0'.
+    """
     
-def writeMe(data,path,emptyFirst = True, replaceLabel = False,correctName = False):
+    strings = []
+    for column in columns:
+        column = np.asarray(column)
+        if column.dtype.kind == 'f' and precision is not None:
+            form = '%.'+str(precision)+'g'
+            strings.append([form % value for value in column.tolist()])
+        elif column.dtype == np.float64:
+            # repr of python floats, same as str() of np.float64 but faster
+            strings.append(list(map(repr,column.tolist())))
+        else:
+            strings.append(column.astype(str).tolist())
+    if replaceLabel and len(columns) >= 2:
+        label = np.asarray(columns[-2])
+        keep = (label == '0') if label.dtype.kind in 'US' else (label == 0)
+        strings[-2] = [string if kept else '1' for string,kept in zip(strings[-2],keep.tolist())]
+    return ''.join([','.join(row)+'\n' for row in zip(*strings)])
+
+def writeMe(data,path,emptyFirst = True, replaceLabel = False,correctName = False,
+            header = None,precision = None,blockSize = 100000):
     """
     Function writes a new featureset using the data provided. This can be used
     to write a new featuerset, add entries to an existing one, or convert a
     featureset designed for a regressor into one built for a classifier. It
     is fully agnostic to the number of features, but assumes that the second
     to last entry is the featureset is the lable.
+    
+    data is a structured array (e.g., from np.genfromtxt with dtype=None), a
+    2D array or a list of equal length rows. Rows are formatted in blocks of 
+    blockSize rows (see formatColumns for replaceLabel and precision) and 
+    written through a single file handle, after the header line if given.
+    correctName is kept for compatibility, names are written as they are.
     """
     
-    # Empty outfile
-    if emptyFirst:
-        with open(path, 'w+') as f:
-            f.write('')
+    # Columns of the data
+    if isinstance(data,np.ndarray) and data.dtype.names:
+        columns = [data[name] for name in data.dtype.names]
+    elif isinstance(data,np.ndarray) and data.ndim == 2:
+        columns = list(data.T)
+    else:
+        columns = [np.asarray(column) for column in zip(*data)]
     
-    # Write Entry, one at a time into file in .csv format
-    for datum in data:
-        
-        #Allow for varible lenght entries
-        entryLength = len(datum)
-        
-        if replaceLabel:
-            labelLocation = entryLength - 2
-        else:
-            labelLocation = entryLength + 2
-            
-        if correctName:
-            nameLocation = entryLength - 1
-        else:
-            nameLocation = entryLength + 1
-        
-        #Write actual entry
-        with open(path, 'a+') as f:
-            for i in range(entryLength):
-                if i != labelLocation:
-                    if i != nameLocation:
-                        f.write(str(datum[i]))
-                    else:
-                        #f.write(str(datum[i]).split('b\'')[1].split('\'')[0])
-                        #print(datum.shape)
-                        f.write(str(datum[i]))
-                elif datum[i] != 0 and datum[i] != '0':
-                    f.write('1')
-                else:
-                    f.write(datum[i])
-                if i < entryLength - 1:
-                    f.write(',')
-            f.write('\n')
+    # Write entries a block at a time into file in .csv format, emptying it
+    # first unless appending
+    with open(path,'w' if emptyFirst else 'a') as f:
+        if header is not None:
+            f.write(header+'\n')
+        for start in range(0,len(data),blockSize):
+            f.write(formatColumns([column[start:start+blockSize] for column in columns],
+                                  replaceLabel,precision))
@@ -3,6 +3,9 @@
 #
 # Functions for extraction of magnetic complexity features from magnetograms.
 #
+# The feature names and the intermediate products each feature group needs
+# are registered in featureGroups at the end of this file.
+#
 #             GRADIENT FEATURES
 #               Gradient mean
 #               Gradient std
@@ -63,7 +66,6 @@
 from astropy.io import fits
 from scipy.signal import *
 import numpy as np
-from scipy.stats import skew,kurtosis
 from scipy import ndimage
 import pywt
 from skimage import measure
@@ -72,81 +74,311 @@ from skimage import measure
 #Last update: Summer 2019
 # lboucher fixed unsignedSum feature 10/20/2021
 
+# Filtering backend used by gradient and smoothNL. All backends use the
+# boundary semantics of convolve2d(...,mode='same') with zero padding.
+#   'convolve2d' - direct 2D convolution (reference implementation)
+#   'separable'  - separable 1D Sobel passes and running-sum box filter
+#   'fft'        - FFT based convolution
+# The running sums and the FFT would spread a NaN over the whole image, so
+# images (or stacks) containing NaNs are always filtered with convolve2d.
+filterBackend = 'convolve2d'
+filterBackends = ('convolve2d','separable','fft')
+
+
+# Number of histogram bins used for the gradient median. None computes the
+# exact median by selection; an integer computes it from a histogram, with an
+# error of at most (max-min)/gradMedianBins.
+gradMedianBins = None
+
+
+# Region of interest used for neutral line extraction. With roiFraction set,
+# contours are only traced inside the bounding boxes of the strong-field
+# regions (|B| >= roiFraction * max|B|, e.g. 0.2 as in findTGWNL), grown by 
+# roiMargin pixels. None traces contours over the whole image.
+roiFraction = None
+roiMargin = 10
+
+
+def setFilterBackend(backend):
+    #select the filtering backend for the current run
+    global filterBackend
+    if backend not in filterBackends:
+        raise ValueError('Unknown filter backend '+str(backend)+
+                         ', expected one of '+str(filterBackends))
+    filterBackend = backend
+
+
+def floatImage(image):
+    #float32 images are kept in float32, anything else is computed in float64
+    image = np.asarray(image)
+    if image.dtype == np.float32:
+        return image
+    return image.astype(float,copy=False)
+
+
+def imageBackend(image):
+    #backend used to filter an image, convolve2d if it contains NaNs so that
+    #each NaN only spreads over the filter support as with convolve2d
+    if filterBackend != 'convolve2d' and np.isnan(image).any():
+        return 'convolve2d'
+    return filterBackend
+
+
+def convolveSame(image,kernel):
+    #2D convolution over the last two axes with the convolve2d or fft
+    #backend, so that a stack of images can be filtered in one call
+    image = floatImage(image)
+    kernel = np.asarray(kernel,dtype=image.dtype)
+    if imageBackend(image) == 'fft':
+        kernel = kernel.reshape((1,)*(image.ndim-2)+kernel.shape)
+        return fftconvolve(image,kernel,mode='same',axes=(-2,-1))
+    if image.ndim == 2:
+        return convolve2d(image,kernel,mode='same')
+    frames = image.reshape((-1,)+image.shape[-2:])
+    out = np.stack([convolve2d(frame,kernel,mode='same') for frame in frames])
+    return out.reshape(image.shape[:-2]+out.shape[-2:])
+
+
 def fluxValues(magnetogram):
     #compute sum of positive and negative values,
     #then evaluate a signed and unsigned sum.
-    posSum = np.sum(magnetogram[magnetogram>0])
-    negSum = np.sum(magnetogram[magnetogram<0])
+    #a stack of images gives one sum per image
+    magnetogram = getContext(magnetogram).image
+    posSum = np.sum(np.where(magnetogram>0,magnetogram,0),axis=(-2,-1))
+    negSum = np.sum(np.where(magnetogram<0,magnetogram,0),axis=(-2,-1))
     signSum = posSum + negSum
     unsignSum = posSum-negSum
     
     return posSum,negSum, signSum, unsignSum
 
 
+class FeatureContext:
+    #intermediate products of a single image (gradient magnitude, smoothed
+    #field, neutral line contours) computed once on first use and shared
+    #between the feature groups
+    def __init__(self,image,grad=None,smoothed=None):
+        self.image = image
+        self._grad = grad
+        self._smoothed = smoothed
+        self._contours = None
+        self._frames = dict()
+        self.roiSkipped = 0.
+
+    @property
+    def grad(self):
+        if self._grad is None:
+            self._grad = gradient(self.image)
+        return self._grad
+
+    @property
+    def smoothed(self):
+        if self._smoothed is None:
+            self._smoothed = smoothNL(self.image)
+        return self._smoothed
+
+    @property
+    def contours(self):
+        if self._contours is None:
+            if roiFraction is None:
+                self._contours = measure.find_contours(self.smoothed,level = 0)
+            else:
+                self._contours = self.roiContours()
+        return self._contours
+
+    def roiContours(self):
+        #trace contours of the smoothed field inside each region of interest
+        #only and record the fraction of the image area skipped
+        boxes = roiBoxes(self.image)
+        contours = []
+        area = 0
+        for rows,cols in boxes:
+            area += (rows.stop-rows.start)*(cols.stop-cols.start)
+            for contour in measure.find_contours(self.smoothed[rows,cols],level = 0):
+                contours.append(contour+[rows.start,cols.start])
+        self.roiSkipped = 1.-float(area)/np.size(self.image)
+        return contours
+
+    def frame(self,n):
+        #context of image n of a stack, sharing the stack intermediates
+        #computed before the first call
+        if n not in self._frames:
+            self._frames[n] = FeatureContext(self.image[n],
+                              None if self._grad is None else self._grad[n],
+                              None if self._smoothed is None else self._smoothed[n])
+        return self._frames[n]
+
+
+def roiBoxes(image):
+    #bounding boxes of the strong-field regions grown by roiMargin, with
+    #overlapping boxes merged so no area is traced twice
+    field = np.absolute(image)
+    if not np.any(field > 0):
+        return []
+    strong = field >= roiFraction*np.nanmax(field)
+    grown = ndimage.maximum_filter(strong,size=2*roiMargin+1,mode='constant')
+    labels, num = ndimage.label(grown,[[1,1,1],[1,1,1],[1,1,1]])
+    boxes = [[box[0].start,box[0].stop,box[1].start,box[1].stop]
+             for box in ndimage.find_objects(labels)]
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(boxes)):
+            for j in range(i+1,len(boxes)):
+                a = boxes[i]
+                b = boxes[j]
+                if a[0]<b[1] and b[0]<a[1] and a[2]<b[3] and b[2]<a[3]:
+                    boxes[i] = [min(a[0],b[0]),max(a[1],b[1]),
+                                min(a[2],b[2]),max(a[3],b[3])]
+                    del boxes[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return [(slice(box[0],box[1]),slice(box[2],box[3])) for box in boxes]
+
+
+def getContext(image):
+    #allow the feature functions to be called with either an image or a
+    #FeatureContext already shared with other feature groups
+    if isinstance(image,FeatureContext):
+        return image
+    return FeatureContext(image)
+
+
 def gradient(image):
     #use sobel operators to find the gradient
+    #of an image or of each image in a stack
     sobelx = [[-1,0,1],[-2,0,2],[-1,0,1]]
     sobely = [[1,2,1],[0,0,0],[-1,-2,-1]]
     
-    gx = convolve2d(image,sobelx,mode='same')
-    gy = convolve2d(image,sobely,mode='same')
+    image = floatImage(image)
+    if imageBackend(image) == 'separable':
+        #sobelx = [1,2,1]^T [-1,0,1] and sobely = [1,0,-1]^T [1,2,1]
+        gx = ndimage.convolve1d(ndimage.convolve1d(image,[1,2,1],axis=-2,
+                                mode='constant'),[-1,0,1],axis=-1,mode='constant')
+        gy = ndimage.convolve1d(ndimage.convolve1d(image,[1,0,-1],axis=-2,
+                                mode='constant'),[1,2,1],axis=-1,mode='constant')
+    else:
+        gx = convolveSame(image,sobelx)
+        gy = convolveSame(image,sobely)
     
-    M = (gx**2 + gy**2)**(1./2)
+    M = np.sqrt(gx**2 + gy**2)
     
     return M
 
 
 def Gradfeat(image):
     #evaluate statistics of the gradient image
-    res = gradient(image).flatten()
-    men = np.mean(res)
-    strd = np.std(res)
-    med = np.median(res)
-    minim = np.amin(res)
-    maxim = np.amax(res)
-    skw = skew(res)
-    kurt = kurtosis(res)
+    grad = getContext(image).grad
+    res = grad.reshape(grad.shape[:-2]+(-1,))
+    return gradStats(res)
+
+
+def gradStats(res):
+    #statistics along the last axis, so that the flattened gradient images
+    #of a stack (one per row) give one value per image
+    #mean, std, skewness and kurtosis share a single centered copy of the 
+    #data, giving the same values as np.std and the biased scipy.stats skew 
+    #and (Fisher) kurtosis
+    men = np.mean(res,axis=-1)
+    d = res - np.expand_dims(men,-1)
+    d2 = d*d
+    m2 = np.mean(d2,axis=-1)
+    m3 = np.mean(d2*d,axis=-1)
+    d2 *= d2
+    m4 = np.mean(d2,axis=-1)
+    strd = np.sqrt(m2)
+    med = gradMedian(res)
+    minim = np.amin(res,axis=-1)
+    maxim = np.amax(res,axis=-1)
+    with np.errstate(all='ignore'):
+        zero = m2 <= (np.finfo(m2.dtype).eps*men)**2
+        skw = np.where(zero,np.nan,m3/m2**1.5)[()]
+        kurt = np.where(zero,np.nan,m4/m2**2-3.)[()]
     return men,strd,med,minim,maxim,skw,kurt
 
 
-def wavel(image):
-    #create wavelet transform array for display
-    #can be added to the return statement for 
-    #visualization
-    wt = pywt.wavedecn(image,'haar',level=5)
-    arr, coeff_slices = pywt.coeffs_to_array(wt)
+def gradMedian(res):
+    #median along the last axis by selection (np.partition), or with 
+    #gradMedianBins set, from a histogram of each row between its min and max
+    #with an error of at most (max-min)/gradMedianBins
+    n = res.shape[-1]
+    if gradMedianBins is None:
+        part = np.partition(res,[(n-1)//2,n//2],axis=-1)
+        med = 0.5*(part[...,(n-1)//2]+part[...,n//2])
+        return np.where(np.isnan(np.sum(res,axis=-1)),np.nan,med)[()]
+    rows = res.reshape(-1,n)
+    lo = np.amin(rows,axis=-1)
+    width = (np.amax(rows,axis=-1)-lo)/gradMedianBins
+    constant = width == 0
+    width[constant] = 1.
+    bins = ((rows-lo[:,None])/width[:,None]).astype(int)
+    np.clip(bins,0,gradMedianBins-1,out=bins)
+    bins += gradMedianBins*np.arange(len(rows))[:,None]
+    counts = np.bincount(bins.ravel(),minlength=len(rows)*gradMedianBins)
+    counts = counts.reshape(len(rows),gradMedianBins)
+    cum = np.cumsum(counts,axis=-1)
+    target = 0.5*n
+    k = np.argmax(cum >= target,axis=-1)
+    below = np.take_along_axis(cum,k[:,None],-1)[:,0]
+    inbin = np.take_along_axis(counts,k[:,None],-1)[:,0]
+    med = lo + width*(k + (target-(below-inbin))/inbin)
+    #constant rows have their value as median
+    med[constant] = lo[constant]
+    return med.reshape(res.shape[:-1])[()]
+
+
+def wavel(image,visualize=False):
+    #compute wavelet energy of each detail level from a single 5 level
+    #decomposition, a stack of images gives one energy per image
+    image = getContext(image).image
+    coeffs = pywt.wavedec2(image,'haar',level=5,axes=(-2,-1))
+    LL,L5,L4,L3,L2,L1 = coeffs
+    L1e,L2e,L3e,L4e,L5e = [sum(np.sum(np.absolute(detail),axis=(-2,-1))
+                               for detail in level)
+                           for level in (L1,L2,L3,L4,L5)]
     
-    #compute wavelet energy
-    LL,L5,L4,L3,L2,L1 = pywt.wavedec2(image,'haar',level=5)
-    L1e = np.sum(np.absolute(L1))
-    L2e = np.sum(np.absolute(L2))
-    L3e = np.sum(np.absolute(L3))
-    L4e = np.sum(np.absolute(L4))
-    L5e = np.sum(np.absolute(L5))
+    #optionally return the wavelet transform array of the same decomposition
+    #for display
+    if visualize:
+        arr, coeff_slices = pywt.coeffs_to_array(coeffs)
+        return L1e,L2e,L3e,L4e,L5e,arr
     
     return L1e,L2e,L3e,L4e,L5e
 
 
-def extractNL(image):
+def smoothNL(image):
     avg10 = (1. / 100)*np.ones([10,10])
-    avgim = convolve2d(image,avg10,mode='same')
-    out = measure.find_contours(avgim,level = 0)
-    return out
+    image = floatImage(image)
+    if imageBackend(image) == 'separable':
+        #running mean over the same 10x10 window (rows/cols i-5..i+4) that
+        #convolve2d centers the even kernel on
+        avgim = ndimage.uniform_filter(image,size=(1,)*(image.ndim-2)+(10,10),
+                                       mode='constant')
+    else:
+        avgim = convolveSame(image,avg10)
+    return avgim
 
 
-def NLmaskgen(contours,image):
-    mask = np.zeros((image.shape))
-    for n,contour in enumerate(contours):
-        #print(n,contour)
-        for i in range(len(contour)):
-            y = int(round(contour[i,1]))
-            x = int(round(contour[i,0]))
-            mask[x,y] = 1.
+def extractNL(image):
+    return getContext(image).contours
+
+
+def NLmaskgen(contours,image,compact=False):
+    #round all contour vertices at once and scatter them into the mask,
+    #compact=True returns a boolean mask instead of float64
+    mask = np.zeros(np.shape(image)[-2:],dtype=bool if compact else float)
+    if len(contours) == 0:
+        return mask
+    points = np.around(np.concatenate(contours)).astype(int)
+    mask[points[:,0],points[:,1]] = 1
     return mask
 
 
-def findTGWNL(image):
+def findTGWNL(image,compact=False):
     m = 0.2*np.amax(np.absolute(image))
+    if compact:
+        return np.absolute(image)>=m
     width = image.shape[0]
     height = image.shape[1]
     out = np.zeros([height,width])
@@ -155,73 +387,139 @@ def findTGWNL(image):
     return out
 
 
+def contourOffsets(contours):
+    #offsets of each contour in the concatenation of all contours, the
+    #points of contour n are at [offsets[n]:offsets[n+1]]
+    offsets = np.zeros(len(contours)+1,dtype=int)
+    np.cumsum([len(contour) for contour in contours],out=offsets[1:])
+    return offsets
+
+
+def nextIndex(offsets):
+    #index of the next point along each contour, wrapping the last point
+    #of a contour around to its first point
+    nxt = np.arange(1,offsets[-1]+1)
+    nxt[offsets[1:]-1] = offsets[:-1]
+    return nxt
+
+
+def curvatureAll(contours):
+    #evaluate the angles of all contours at once, returns a single angle
+    #buffer along with the per-contour offsets into it
+    offsets = contourOffsets(contours)
+    points = np.around(np.concatenate(contours))
+    nxt = nextIndex(offsets)
+    num = points[nxt,1]-points[:,1]
+    den = points[nxt,0]-points[:,0]
+    angles = np.where(num < 0,3*np.pi/2,np.pi/2)
+    nonzero = den != 0
+    angles[nonzero] = np.arctan(num[nonzero]/den[nonzero])
+    return angles,offsets
+
+
+def bendergyAll(angles,offsets):
+    #evaluate the bending energy of every contour in the angle buffer
+    diff = (angles-angles[nextIndex(offsets)])**2
+    return np.add.reduceat(diff,offsets[:-1])/np.diff(offsets)
+
+
 def curvature(contour):
-    angles = np.zeros([contour.shape[0]])
-    yvals = np.around(contour[:,1])
-    xvals = np.around(contour[:,0])
-    for i in range(contour.shape[0]):
-        if i < contour.shape[0]-1:
-            n = i+1
-        else:
-            n = 0
-        y = int(yvals[i])
-        x = int(xvals[i])
-        yn = int(yvals[n])
-        xn = int(xvals[n])
-        num = yn-y
-        den = xn-x
-        if den != 0:
-            angles[i] = np.arctan(num/den)
-        elif num < 0:
-            angles[i] = 3*np.pi/2
-        else:
-            angles[i] = np.pi/2
+    angles,offsets = curvatureAll([contour])
     return angles
 
 
 def bendergy(angles):
-    fact = 1. / len(angles)
-    count = 0.
-    for i in range(len(angles)):
-        if i < len(angles)-1:
-            n = i+1
-        else:
-            n = 0
-        T = angles[i]
-        Tn = angles[n]
-        count += (T-Tn)**2
-        
-    BE = count*fact
-    return BE
+    offsets = np.array([0,len(angles)])
+    return bendergyAll(angles,offsets)[0]
 
 
-def NLfeat(image):
-    grad = gradient(image)
-    contours = extractNL(image)
-    ma = NLmaskgen(contours,image)
-    gwnl = np.zeros([grad.shape[0],grad.shape[1]])
+def NLlenfeat(image):
+    #neutral line length, number of fragments and gradient-weighted length
+    context = getContext(image)
+    contours = context.contours
+    if not contours:
+        return 0.,0.,0.
+    grad = context.grad
+    ma = NLmaskgen(contours,context.image,compact=True)
     gwnl = grad*ma
-    thresh = findTGWNL(gwnl)
-    NLlen = np.sum(thresh)
+    thresh = findTGWNL(gwnl,compact=True)
+    NLlen = np.count_nonzero(thresh)
     
     struct = [[1,1,1],[1,1,1],[1,1,1]]
     lines, numlines = ndimage.label(thresh,struct)
     
-    GWNLlen = np.sum(ma)
-    Flag = True
+    GWNLlen = np.count_nonzero(ma)
+    
+    return float(NLlen),float(numlines),float(GWNLlen)
+
+
+def NLcurvefeat(image):
+    #statistics of the neutral line curvature and bending energy
+    contours = getContext(image).contours
     if not contours:
-        return 0.,0.,0.,0.,0.,0.,0.,0.,0.,0.,0.,0.,0.
-    else:
-        for n,contour in enumerate(contours):
-            curve = curvature(contour)
-            if Flag:
-                angstore = np.zeros([len(curve)])
-                angstore = curve
-                BEstore = np.zeros([len(contours)])
-                Flag = False
-            else:
-                angstore = np.concatenate((curve,angstore))
-            BEstore[n] = bendergy(curve)
+        return 0.,0.,0.,0.,0.,0.,0.,0.,0.,0.
+    angstore,offsets = curvatureAll(contours)
+    BEstore = bendergyAll(angstore,offsets)
     
-    return float(NLlen),float(numlines),float(GWNLlen),float(np.mean(angstore)),np.std(angstore),np.median(angstore),np.amin(angstore),np.amax(angstore),np.mean(BEstore),np.std(BEstore),np.median(BEstore),np.amin(BEstore),np.amax(BEstore)
+    return float(np.mean(angstore)),np.std(angstore),np.median(angstore),np.amin(angstore),np.amax(angstore),np.mean(BEstore),np.std(BEstore),np.median(BEstore),np.amin(BEstore),np.amax(BEstore)
+
+
+def NLfeat(image):
+    context = getContext(image)
+    return NLlenfeat(context)+NLcurvefeat(context)
+
+
+# Intermediate products of FeatureContext and the intermediates each of
+# them is computed from
+intermediateDependencies = {'grad':(),
+                            'smoothed':(),
+                            'contours':('smoothed',)}
+
+# Registry of the features, in the column order of FeaturesetTools.concatVals.
+# Each feature group is listed as
+#   (group name, group function, intermediates used, per-image only, 
+#    names of the features returned by the group function)
+featureGroups = [
+    ('gradient',Gradfeat,('grad',),False,
+     ['Gradient mean','Gradient std','Gradient median','Gradient min',
+      'Gradient max','Gradient skewness','Gradient kurtosis']),
+    ('neutral line length',NLlenfeat,('grad','contours'),True,
+     ['NL length','NL no. fragments','NL gradient-weighted len']),
+    ('neutral line curvature',NLcurvefeat,('contours',),True,
+     ['NL curvature mean','NL curvature std','NL curvature median',
+      'NL curvature min','NL curvature max','NL bending energy mean',
+      'NL bending energy std','NL bending energy median',
+      'NL bending energy min','NL bending energy max']),
+    ('wavelet',wavel,(),False,
+     ['Wavelet Energy L1','Wavelet Energy L2','Wavelet Energy L3',
+      'Wavelet Energy L4','Wavelet Energy L5']),
+    ('flux',fluxValues,(),False,
+     ['Total positive flux','Total negative flux','Total signed flux',
+      'Total unsigned flux']),
+    ]
+featureNames = [name for group in featureGroups for name in group[4]]
+
+
+def selectGroups(features=None):
+    #feature groups needed to compute the requested feature names
+    if features is None:
+        return featureGroups
+    unknown = [name for name in features if name not in featureNames]
+    if unknown:
+        raise ValueError('Unknown features '+str(unknown)+
+                         ', expected names from FunctionsP3.featureNames')
+    return [group for group in featureGroups 
+            if any(name in features for name in group[4])]
+
 
+def requiredIntermediates(features=None):
+    #intermediate products needed to compute the requested feature names,
+    #including the intermediates they are computed from
+    required = []
+    pending = [name for group in selectGroups(features) for name in group[2]]
+    while pending:
+        name = pending.pop()
+        if name not in required:
+            required.append(name)
+            pending.extend(intermediateDependencies[name])
+    return required
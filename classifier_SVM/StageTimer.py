@@ -0,0 +1,107 @@
+#-------------------------------------------------------------------------------
+# StageTimer.py
+#
+# Opt-in timing of the stages of the feature extraction (image load,
+# intermediate products and feature groups of FeaturesetTools.concatVals),
+# used by Build_Featureset.py when a timingFile is specified.
+#
+#  - Each process accumulates, per stage, the number of calls, the total time
+#    and a histogram of the call durations in logarithmic bins (20 per decade
+#    from 1 us, i.e., percentiles are resolved to about 12%), so the memory
+#    used does not grow with the number of images.
+#  - When disabled (the default), start() returns None and record() returns
+#    immediately, so the instrumented code only pays two function calls per
+#    stage.
+#
+# Copyright 2022 Laura Boucheron, Jeremy Grajeda, Ellery Wuest
+# This file is part of AR-flares
+#
+# AR-flares is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# AR-flares is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# AR-flares. If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import math
+import time
+
+enabled = False # set to True to record stage timings
+minTime = 1e-6 # lower edge of the first histogram bin, in seconds
+binsPerDecade = 20
+numBins = 9*binsPerDecade # up to 1000 s, longer calls go to the last bin
+
+histograms = dict() # stage -> [bin counts, total time] of this process
+
+def start():
+    # start time of a stage, or None when timing is disabled
+    if enabled:
+        return time.perf_counter()
+    return None
+
+def record(stage,started):
+    # add the duration of a stage started at started to its histogram
+    if started is None:
+        return
+    elapsed = time.perf_counter()-started
+    if elapsed > minTime:
+        index = min(int(math.log10(elapsed/minTime)*binsPerDecade),numBins-1)
+    else:
+        index = 0
+    if stage not in histograms:
+        histograms[stage] = [[0]*numBins,0.]
+    histograms[stage][0][index] += 1
+    histograms[stage][1] += elapsed
+
+def collect():
+    # return and reset the histograms recorded in this process since the
+    # last call, e.g., to send them from a pool worker to the parent
+    collected = dict(histograms)
+    histograms.clear()
+    return collected
+
+def merge(total,collected):
+    # add histograms returned by collect() to total
+    for stage,(counts,elapsed) in collected.items():
+        if stage not in total:
+            total[stage] = [[0]*numBins,0.]
+        total[stage][0] = [a+b for a,b in zip(total[stage][0],counts)]
+        total[stage][1] += elapsed
+
+def summarize(stages):
+    """
+    Returns, for each stage of a set of histograms, the number of calls, the
+    total and mean time and the 50th, 95th and 99th percentile times (upper
+    edge of the histogram bin containing the percentile), in seconds.
+    """
+
+    summary = dict()
+    for stage,(counts,elapsed) in stages.items():
+        count = sum(counts)
+        result = {'count':count,'total':elapsed,'mean':elapsed/max(count,1)}
+        for percentile in (50,95,99):
+            cumulative = 0
+            for index,binCount in enumerate(counts):
+                cumulative += binCount
+                if cumulative >= percentile/100.*count:
+                    break
+            result['p'+str(percentile)] = minTime*10**((index+1.)/binsPerDecade)
+        summary[stage] = result
+    return summary
+
+def writeTimings(filename,workers):
+    # write the stage summary of each worker (pid -> histograms) and of all
+    # workers together to a json file
+    total = dict()
+    for stages in workers.values():
+        merge(total,stages)
+    with open(filename,'w') as f:
+        json.dump({'all':summarize(total),
+                   'workers':dict((str(pid),summarize(stages))
+                                  for pid,stages in workers.items())},f,indent=1)
@@ -0,0 +1,114 @@
+#-------------------------------------------------------------------------------
+# SyntheticMagnetograms.py
+#
+# Deterministic synthetic line-of-sight magnetograms for benchmarking and
+# checking FunctionsP3.py without the AR Dataset. Each magnetogram is a sum of
+# Gaussian flux concentrations (poles) of alternating polarity with peak
+# fields of 500-3000 G, plus a smooth mixed-polarity background and 10 G
+# Gaussian noise (the HMI noise level), so that it has neutral lines between
+# the poles and many short noise neutral lines elsewhere, as real patches do.
+#
+#  - magnetogram(kind,size,seed) returns one image, with kind:
+#       'bipolar'     two poles of opposite polarity (simple AR)
+#       'multipolar'  six poles of alternating polarity (complex AR)
+#       'nan'         multipolar with a band of NaNs, as in patches near
+#                     the limb
+#       'flat'        all zeros (no flux, no neutral lines)
+#  - benchmarkSet(sizes) returns all kinds at the reduced (224x224) and full
+#    (600x600) resolution sizes, used by Benchmark_FunctionsP3.py.
+#  - Run as a script to write a small synthetic dataset of fits files in AR
+#    folders, with a label file, for Build_Featureset.py:
+#       python SyntheticMagnetograms.py <datasetDir> <labelFile>
+#                                       [--ars N] [--files N] [--size N]
+#
+# Copyright 2022 Laura Boucheron, Jeremy Grajeda, Ellery Wuest
+# This file is part of AR-flares
+#
+# AR-flares is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# AR-flares is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# AR-flares. If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import argparse
+import numpy as np
+from astropy.io import fits
+
+kinds = ('bipolar','multipolar','nan','flat')
+
+def poles(size,numPoles,rng):
+    # Gaussian flux concentrations of alternating polarity
+    y,x = np.mgrid[0:size,0:size]
+    field = np.zeros((size,size))
+    for n in range(numPoles):
+        row,col = rng.uniform(0.25,0.75,2)*size
+        width = rng.uniform(0.03,0.08)*size
+        peak = rng.uniform(500,3000)*(1 if n%2==0 else -1)
+        field += peak*np.exp(-((x-col)**2+(y-row)**2)/(2*width**2))
+    return field
+
+def magnetogram(kind,size,seed=0):
+    """
+    Returns a synthetic magnetogram of the given kind (see kinds) as a
+    size x size float64 array. The same kind, size and seed always give the
+    same image.
+    """
+
+    if kind not in kinds:
+        raise ValueError('Unknown magnetogram kind '+str(kind)+', use one of '+str(kinds))
+    if kind == 'flat':
+        return np.zeros((size,size))
+    rng = np.random.default_rng(seed)
+    field = poles(size,2 if kind == 'bipolar' else 6,rng)
+    # weak mixed-polarity background, smooth on the scale of 1/16 of the image
+    coarse = rng.normal(0,50,(16,16))
+    field += np.kron(coarse,np.ones((size//16+1,size//16+1)))[:size,:size]
+    field += rng.normal(0,10,(size,size))
+    if kind == 'nan':
+        field[:,:size//8] = np.nan
+    return field
+
+def benchmarkSet(sizes=(224,600),seed=0):
+    # all kinds at all sizes, keyed by kind_size
+    return dict((kind+'_'+str(size),magnetogram(kind,size,seed))
+                for size in sizes for kind in kinds)
+
+def writeDataset(datasetDir,labelFile,numARs=4,filesPerAR=6,size=224,seed=0):
+    """
+    Writes numARs AR folders of filesPerAR fits magnetograms (image in HDU 1,
+    named as the HMI files of the AR Dataset) and a label file with random
+    flare classes.
+    """
+
+    rng = np.random.default_rng(seed)
+    with open(labelFile,'w') as f:
+        for ar in range(numARs):
+            folder = os.path.join(datasetDir,str(11000+ar))
+            os.makedirs(folder,exist_ok=True)
+            kind = 'bipolar' if ar%2==0 else 'multipolar'
+            for n in range(filesPerAR):
+                name = '%d_hmi.M_720s.201101%02d_%02d0000_TAI.1.magnetogram.fits' \
+                       % (11000+ar,1+n//24,n%24)
+                image = magnetogram(kind,size,seed*1000+ar*100+n)
+                fits.HDUList([fits.PrimaryHDU(),fits.ImageHDU(image)]).writeto(
+                    os.path.join(folder,name),overwrite=True)
+                label = rng.choice(['0','0','C1.0','M2.5'])
+                f.write(name+','+label+'\n')
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Write a synthetic AR dataset')
+    parser.add_argument('datasetDir')
+    parser.add_argument('labelFile')
+    parser.add_argument('--ars',type=int,default=4,help='number of AR folders')
+    parser.add_argument('--files',type=int,default=6,help='number of files per AR')
+    parser.add_argument('--size',type=int,default=224,help='image size in pixels')
+    args = parser.parse_args()
+    writeDataset(args.datasetDir,args.labelFile,args.ars,args.files,args.size)
+    print('Wrote',args.ars*args.files,'magnetograms to',args.datasetDir)
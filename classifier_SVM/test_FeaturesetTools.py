@@ -0,0 +1,173 @@
+#-------------------------------------------------------------------------------
+# test_FeaturesetTools.py
+#
+# Parity tests of the vectorized feature equalization of FeaturesetTools.py
+# against the original deepcopy/loop implementations.
+#
+#  - Run with pytest from the classifier_SVM/ directory:
+#       python -m pytest -q test_FeaturesetTools.py
+#
+# Copyright 2022 Laura Boucheron, Jeremy Grajeda, Ellery Wuest
+# This file is part of AR-flares
+#
+# AR-flares is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# AR-flares is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# AR-flares. If not, see <https://www.gnu.org/licenses/>.
+
+import copy
+import warnings
+import numpy as np
+import pytest
+import FeaturesetTools
+
+# Reference implementations: the deepcopy/loop versions of the equalization
+# functions, before the vectorization of FeaturesetTools.py
+
+def loopEqualizeTrainData(trainData,limit=None):
+    Data = copy.deepcopy(trainData)
+    if limit is None:
+        limit = len(Data[0])
+    dataLength = len(Data)
+    eqFactors = np.zeros([limit,2])
+    for i in range(limit):
+        if isinstance(Data[0][i],float):
+            featureValues = np.zeros(dataLength)
+            for j in range(dataLength):
+                featureValues[j] = Data[j][i] * 1.0
+            eqFactors[i,0] = np.amin(featureValues)
+            for j in range(dataLength):
+                Data[j][i] = Data[j][i] - eqFactors[i,0]
+                featureValues[j] = Data[j][i] * 1.0
+            eqFactors[i,1] = np.amax(featureValues)
+            if eqFactors[i,1] != 0:
+                for j in range(dataLength):
+                    Data[j][i] = Data[j][i] / eqFactors[i,1]
+        else:
+            eqFactors[i,1] = 1
+    return Data, eqFactors
+
+def loopEqualizeNewData(newData,eqFactors):
+    Data = copy.deepcopy(newData)
+    for i in range(len(eqFactors)):
+        for j in range(len(Data)):
+            if isinstance(Data[j][i],float):
+                Data[j][i] = float(Data[j][i]) - eqFactors[i,0]
+                if eqFactors[i,1] != 0:
+                    Data[j][i] = float(Data[j][i]) / float(eqFactors[i,1])
+    return Data
+
+def features(rows=200,columns=6,constant=False,nans=False,seed=0):
+    # random features with the spread of the magnetic complexity features,
+    # optionally with a constant column and NaNs
+    rng = np.random.default_rng(seed)
+    data = rng.normal(0,1,(rows,columns))*10.**rng.integers(-3,6,columns)
+    if constant:
+        data[:,1] = 3.5
+    if nans:
+        data[rng.integers(0,rows,5),2] = np.nan
+    return data
+
+def featureset(data):
+    # structured array as np.genfromtxt(dtype=None) gives for a feature file:
+    # float features, int label, str flare class and filename
+    rows = len(data)
+    dtype = [('f'+str(i),float) for i in range(data.shape[1])]
+    dtype += [('label',int),('flareClass','U8'),('name','U40')]
+    out = np.zeros(rows,dtype=dtype)
+    for i in range(data.shape[1]):
+        out['f'+str(i)] = data[:,i]
+    out['label'] = np.arange(rows)%2
+    out['flareClass'] = np.where(out['label'] == 1,'M1.0','0')
+    out['name'] = ['%d_hmi.M_720s.fits' % (11000+row//10) for row in range(rows)]
+    return out
+
+def assertSame(values,reference):
+    # equal values and NaNs field by field (or element by element)
+    if values.dtype.names:
+        assert values.dtype == reference.dtype
+        for name in values.dtype.names:
+            np.testing.assert_array_equal(values[name],reference[name])
+    else:
+        np.testing.assert_array_equal(values,reference)
+
+cases = [dict(),dict(constant=True),dict(nans=True),dict(constant=True,nans=True)]
+
+@pytest.fixture(autouse=True)
+def quiet():
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        with np.errstate(all='ignore'):
+            yield
+
+@pytest.mark.parametrize('case',cases)
+@pytest.mark.parametrize('limit',[None,3])
+def test_equalizeTrainData_plain(case,limit):
+    data = features(**case)
+    original = data.copy()
+    values,factors = FeaturesetTools.equalizeTrainData(data,limit)
+    reference,referenceFactors = loopEqualizeTrainData(data,limit)
+    assertSame(values,reference)
+    assertSame(factors,referenceFactors)
+    assertSame(data,original)
+
+@pytest.mark.parametrize('case',cases)
+@pytest.mark.parametrize('limit',[None,3,8])
+def test_equalizeTrainData_structured(case,limit):
+    data = featureset(features(**case))
+    original = data.copy()
+    values,factors = FeaturesetTools.equalizeTrainData(data,limit)
+    reference,referenceFactors = loopEqualizeTrainData(data,limit)
+    assertSame(values,reference)
+    assertSame(factors,referenceFactors)
+    assertSame(data,original)
+
+@pytest.mark.parametrize('case',cases)
+def test_equalizeNewData_plain(case):
+    factors = FeaturesetTools.equalizeTrainData(features(**case))[1]
+    data = features(seed=1,**case)
+    original = data.copy()
+    assertSame(FeaturesetTools.equalizeNewData(data,factors),
+               loopEqualizeNewData(data,factors))
+    assertSame(data,original)
+
+@pytest.mark.parametrize('case',cases)
+@pytest.mark.parametrize('limit',[None,3])
+def test_equalizeNewData_structured(case,limit):
+    factors = FeaturesetTools.equalizeTrainData(featureset(features(**case)),limit)[1]
+    data = featureset(features(seed=1,**case))
+    original = data.copy()
+    assertSame(FeaturesetTools.equalizeNewData(data,factors),
+               loopEqualizeNewData(data,factors))
+    assertSame(data,original)
+
+def test_equalize_out():
+    # in place equalization gives the same result as a new array
+    data = features(constant=True)
+    factors = FeaturesetTools.equalizationFactors(data)
+    expected = FeaturesetTools.equalize(data,factors)
+    FeaturesetTools.equalize(data,factors,out=data)
+    assertSame(data,expected)
+
+def test_createARFolds_loaded(tmp_path):
+    # folds from the loaded labels and filenames are those read from the file
+    data = featureset(features(rows=400))
+    masterFile = str(tmp_path/'master.csv')
+    with open(masterFile,'w') as f:
+        for row in data:
+            f.write(','.join(str(value) for value in row)+'\n')
+    label,names = FeaturesetTools.loadFeatureset(masterFile)[1:]
+    for stratified in (True,False):
+        folds = FeaturesetTools.createARFolds(masterFile,numFolds=4,stratified=stratified)
+        loaded = FeaturesetTools.createARFolds(masterFile,numFolds=4,stratified=stratified,
+                                               label=label,names=names)
+        for (train,test),(loadedTrain,loadedTest) in zip(folds,loaded):
+            np.testing.assert_array_equal(train,loadedTrain)
+            np.testing.assert_array_equal(test,loadedTest)
@@ -0,0 +1,188 @@
+#-------------------------------------------------------------------------------
+# test_FunctionsP3.py
+#
+# Parity tests of the feature extraction functions of FunctionsP3.py against
+# the original loop implementations and the numpy/scipy statistics, on the
+# synthetic magnetograms of SyntheticMagnetograms.py.
+#
+#  - Run with pytest from the classifier_SVM/ directory:
+#       python -m pytest -q test_FunctionsP3.py
+#
+# Copyright 2022 Laura Boucheron, Jeremy Grajeda, Ellery Wuest
+# This file is part of AR-flares
+#
+# AR-flares is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# AR-flares is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# AR-flares. If not, see <https://www.gnu.org/licenses/>.
+
+import warnings
+import numpy as np
+import pytest
+from scipy.signal import convolve2d
+from scipy import ndimage
+from scipy.stats import skew,kurtosis
+from skimage import measure
+import FunctionsP3
+import SyntheticMagnetograms
+
+# Reference implementations: the loop versions of the neutral line functions
+# as first written (Spring 2018), before the vectorization of FunctionsP3.py
+
+def loopGradient(image):
+    sobelx = [[-1,0,1],[-2,0,2],[-1,0,1]]
+    sobely = [[1,2,1],[0,0,0],[-1,-2,-1]]
+    gx = convolve2d(image,sobelx,mode='same')
+    gy = convolve2d(image,sobely,mode='same')
+    return (gx**2 + gy**2)**(1./2)
+
+def loopExtractNL(image):
+    avg10 = (1. / 100)*np.ones([10,10])
+    avgim = convolve2d(image,avg10,mode='same')
+    return measure.find_contours(avgim,level = 0)
+
+def loopNLmaskgen(contours,image):
+    mask = np.zeros((image.shape))
+    for n,contour in enumerate(contours):
+        for i in range(len(contour)):
+            y = int(round(contour[i,1]))
+            x = int(round(contour[i,0]))
+            mask[x,y] = 1.
+    return mask
+
+def loopFindTGWNL(image):
+    m = 0.2*np.amax(np.absolute(image))
+    out = np.zeros([image.shape[1],image.shape[0]])
+    out[abs(image)>=m] = 1
+    return out
+
+def loopCurvature(contour):
+    angles = np.zeros([contour.shape[0]])
+    yvals = np.around(contour[:,1])
+    xvals = np.around(contour[:,0])
+    for i in range(contour.shape[0]):
+        if i < contour.shape[0]-1:
+            n = i+1
+        else:
+            n = 0
+        y = int(yvals[i])
+        x = int(xvals[i])
+        yn = int(yvals[n])
+        xn = int(xvals[n])
+        num = yn-y
+        den = xn-x
+        if den != 0:
+            angles[i] = np.arctan(num/den)
+        elif num < 0:
+            angles[i] = 3*np.pi/2
+        else:
+            angles[i] = np.pi/2
+    return angles
+
+def loopBendergy(angles):
+    fact = 1. / len(angles)
+    count = 0.
+    for i in range(len(angles)):
+        if i < len(angles)-1:
+            n = i+1
+        else:
+            n = 0
+        count += (angles[i]-angles[n])**2
+    return count*fact
+
+def loopNLfeat(image):
+    grad = loopGradient(image)
+    contours = loopExtractNL(image)
+    ma = loopNLmaskgen(contours,image)
+    gwnl = grad*ma
+    thresh = loopFindTGWNL(gwnl)
+    NLlen = np.sum(thresh)
+    lines, numlines = ndimage.label(thresh,[[1,1,1],[1,1,1],[1,1,1]])
+    GWNLlen = np.sum(ma)
+    if not contours:
+        return 0.,0.,0.,0.,0.,0.,0.,0.,0.,0.,0.,0.,0.
+    angstore = np.concatenate([loopCurvature(contour) for contour in contours[::-1]])
+    BEstore = np.array([loopBendergy(loopCurvature(contour)) for contour in contours])
+    return float(NLlen),float(numlines),float(GWNLlen),float(np.mean(angstore)),np.std(angstore),np.median(angstore),np.amin(angstore),np.amax(angstore),np.mean(BEstore),np.std(BEstore),np.median(BEstore),np.amin(BEstore),np.amax(BEstore)
+
+images = [(kind,size) for size in (224,600) for kind in SyntheticMagnetograms.kinds]
+
+@pytest.fixture(autouse=True)
+def defaultSettings():
+    # run each test with the default backend and settings, and restore them
+    saved = (FunctionsP3.filterBackend,FunctionsP3.gradMedianBins,FunctionsP3.roiFraction)
+    FunctionsP3.setFilterBackend('convolve2d')
+    FunctionsP3.gradMedianBins = None
+    FunctionsP3.roiFraction = None
+    yield
+    FunctionsP3.filterBackend,FunctionsP3.gradMedianBins,FunctionsP3.roiFraction = saved
+
+@pytest.mark.parametrize('kind,size',images)
+def test_curvature_bendergy(kind,size):
+    contours = loopExtractNL(SyntheticMagnetograms.magnetogram(kind,size))
+    if not contours:
+        pytest.skip('no neutral line')
+    angles,offsets = FunctionsP3.curvatureAll(contours)
+    energies = FunctionsP3.bendergyAll(angles,offsets)
+    for n,contour in enumerate(contours):
+        reference = loopCurvature(contour)
+        np.testing.assert_array_equal(angles[offsets[n]:offsets[n+1]],reference)
+        np.testing.assert_array_equal(FunctionsP3.curvature(contour),reference)
+        np.testing.assert_allclose(energies[n],loopBendergy(reference),rtol=1e-12)
+        np.testing.assert_allclose(FunctionsP3.bendergy(reference),loopBendergy(reference),rtol=1e-12)
+
+@pytest.mark.parametrize('backend',FunctionsP3.filterBackends)
+@pytest.mark.parametrize('kind,size',images)
+def test_NLfeat(kind,size,backend):
+    image = SyntheticMagnetograms.magnetogram(kind,size)
+    FunctionsP3.setFilterBackend(backend)
+    np.testing.assert_allclose(FunctionsP3.NLfeat(image),loopNLfeat(image),
+                               rtol=1e-12,atol=1e-12)
+
+def test_NLmaskgen():
+    image = SyntheticMagnetograms.magnetogram('multipolar',224)
+    contours = loopExtractNL(image)
+    reference = loopNLmaskgen(contours,image)
+    np.testing.assert_array_equal(FunctionsP3.NLmaskgen(contours,image),reference)
+    np.testing.assert_array_equal(FunctionsP3.NLmaskgen(contours,image,compact=True),reference > 0)
+
+@pytest.mark.parametrize('kind,size',images)
+def test_gradStats(kind,size):
+    grad = FunctionsP3.gradient(SyntheticMagnetograms.magnetogram(kind,size)).flatten()
+    with np.errstate(all='ignore'):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            reference = (np.mean(grad),np.std(grad),np.median(grad),np.amin(grad),
+                         np.amax(grad),skew(grad),kurtosis(grad))
+        values = FunctionsP3.gradStats(grad)
+    np.testing.assert_allclose(values,reference,rtol=1e-10,atol=1e-12)
+
+def test_gradStats_stack():
+    # one row of statistics per image of a stack, as for each image alone
+    stack = np.array([SyntheticMagnetograms.magnetogram(kind,224) 
+                      for kind in SyntheticMagnetograms.kinds])
+    with np.errstate(all='ignore'):
+        values = np.array(FunctionsP3.Gradfeat(stack)).T
+        for image,row in zip(stack,values):
+            np.testing.assert_array_equal(row,FunctionsP3.Gradfeat(image))
+
+@pytest.mark.parametrize('bins',[16,256,4096])
+@pytest.mark.parametrize('kind,size',images)
+def test_gradMedian_bins(kind,size,bins):
+    # histogram median within (max-min)/gradMedianBins of the exact median
+    grad = FunctionsP3.gradient(SyntheticMagnetograms.magnetogram(kind,size)).flatten()
+    FunctionsP3.gradMedianBins = bins
+    with np.errstate(all='ignore'):
+        median = FunctionsP3.gradMedian(grad)
+    if np.isnan(grad).any():
+        assert np.isnan(median)
+    else:
+        bound = (np.amax(grad)-np.amin(grad))/bins
+        assert abs(median-np.median(grad)) <= bound*(1+1e-12)
@@ -53,8 +53,12 @@
 # You should have received a copy of the GNU General Public License along with
 # AR-flares. If not, see <https://www.gnu.org/licenses/>.
 
+import os
+import sys
 import csv
 import numpy as np
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','classifier_SVM'))
+import FeaturesetTools
 
 ## User Definitions
 # Modify the following to reflect the location of the label file (available with the dataset on Dryad)
@@ -78,27 +82,22 @@ with open(labelFile) as f:
     Labels = list(csv.reader(f,delimiter = ','))
 
 
-testdata = ['filename,class']
-traindata = ['filename,class']
-valdata = ['filename,class']
+testdata = []
+traindata = []
+valdata = []
 for label in Labels:
     AR = label[0][:4]
+    if label[1]=='0':
+        row = [AR+'/'+label[0],'0']
+    else:
+        row = [AR+'/'+label[0],'1']
     if AR in testARs:
-        if label[1]=='0':
-            testdata.append(AR+'/'+label[0]+','+'0')
-        else:
-            testdata.append(AR+'/'+label[0]+','+'1')
+        testdata.append(row)
     elif AR in valARs:
-        if label[1]=='0':
-            valdata.append(AR+'/'+label[0]+','+'0')
-        else:
-            valdata.append(AR+'/'+label[0]+','+'1')
+        valdata.append(row)
     else:
-        if label[1]=='0':
-            traindata.append(AR+'/'+label[0]+','+'0')
-        else:
-            traindata.append(AR+'/'+label[0]+','+'1')
+        traindata.append(row)
 
-np.savetxt(testdata_file,testdata,delimiter=',',fmt='%s')
-np.savetxt(valdata_file,valdata,delimiter=',',fmt='%s')
-np.savetxt(traindata_file,traindata,delimiter=',',fmt='%s')
+FeaturesetTools.writeMe(testdata,testdata_file,header='filename,class')
+FeaturesetTools.writeMe(valdata,valdata_file,header='filename,class')
+FeaturesetTools.writeMe(traindata,traindata_file,header='filename,class')
@@ -0,0 +1,65 @@
+#-------------------------------------------------------------------------------
+# Benchmark_MagnetogramReader.py
+#
+# Micro-benchmark of the magnetogram reading rate (files per second) of the
+# reference path (astropy fits.open, verify('silentfix') and a copy of HDU 1)
+# and of MagnetogramReader.py, on a first pass (headers parsed) and a repeat
+# pass (cached layouts). Also checks that both paths return identical images.
+#
+#  - Relies on MagnetogramReader.py and DatasetManifest.py
+#  - Edit the lines under ## User Definitions to specify the dataset location
+#    and the number of files read.
+#  - The first timed path also warms the operating system file cache, so all
+#    paths are timed on cached files; run with the paths reordered to check
+#    cold-cache behavior.
+#
+# Copyright 2022 Ty Vincent, Laura Boucheron
+# This file is part of AR-flares
+#
+# AR-flares is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# AR-flares is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# AR-flares. If not, see <https://www.gnu.org/licenses/>.
+
+import time
+import numpy as np
+from astropy.io import fits
+import DatasetManifest
+import MagnetogramReader
+
+## User Definitions
+dataDirectory = '/mnt/solar_flares/AR_Dataset/Lat60_Lon60_Nans0/' # Path to fits data in NOAA AR number folders
+numFiles = 1000 # number of files read per path
+## End User Definitions
+
+def referenceRead(filename):
+    # reading path used before MagnetogramReader.py
+    with fits.open(filename) as hdulist:
+        hdulist.verify('silentfix')
+        return np.asarray(hdulist[1].data,dtype=float)
+
+def timeReads(function,filenames):
+    # Return the files per second and the images read
+    start = time.perf_counter()
+    images = [function(filename) for filename in filenames]
+    return len(filenames)/(time.perf_counter()-start), images
+
+if __name__=='__main__':
+    filenames = DatasetManifest.listFiles(dataDirectory,'fits')[:numFiles]
+    print('Reading '+str(len(filenames))+' files')
+    referenceRate, reference = timeReads(referenceRead,filenames)
+    print('  %-28s %10.1f files/s' % ('fits.open + verify',referenceRate))
+    MagnetogramReader.layoutCache.clear()
+    for name in ('MagnetogramReader (first)','MagnetogramReader (repeat)'):
+        rate, images = timeReads(MagnetogramReader.readMagnetogram,filenames)
+        same = all(np.array_equal(image,ref,equal_nan=True)
+                   for image, ref in zip(images,reference))
+        print('  %-28s %10.1f files/s  speedup %5.2fx  identical %s'
+              % (name,rate,rate/referenceRate,same))
@@ -0,0 +1,172 @@
+# DESCRIPTION: Dataset manifest, an index of the image files of an AR dataset
+#              stored in folders titled with AR numbers (e.g., the fits files
+#              downloaded from JSOC, or the customized dataset created by
+#              customize_dataset.py). The manifest replaces repeated directory
+#              listings (glob) of the dataset, which are slow on network
+#              mounts, by a single csv file with one line per image:
+#                  relative path, AR folder, observation time, size, mtime
+#              The manifest is built once with a parallel os.scandir walk of
+#              the AR folders and refreshed incrementally: only AR folders
+#              whose modification time changed since the last refresh (i.e.,
+#              files were added, removed or renamed) are listed again. The
+#              modification time of each AR folder is stored in the manifest
+#              as a line whose relative path is the folder name with a
+#              trailing /.
+#              By default the manifest is kept in the working directory, as
+#              the dataset may be on a read-only (shared) mount; if it cannot
+#              be written, the listing is still returned.
+#
+# References:
+# [1] L. E. Boucheron, T. Vincent, J. A. Grajeda, and E. Wuest, "Solar Active
+#     Region Magnetogram Image Dataset for Studies of Space Weather," arXiv
+#     preprint arXiv:2305.09492, 2023.
+#
+# Copyright 2022 Ty Vincent, Laura Boucheron
+# This file is part of AR-flares
+#
+# AR-flares is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# AR-flares is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# AR-flares. If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import re
+import csv
+import hashlib
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+# One image of the dataset; path is relative to the dataset directory
+Entry = namedtuple('Entry',['path','ar','timestamp','size','mtime'])
+
+header = ['path','ar','timestamp','size','mtime']
+
+def defaultManifestFile(dataDirectory,extension):
+    # manifest stored in the working directory, one per dataset directory 
+    # (named after it, with a hash of its absolute path) and file extension
+    dataDirectory = os.path.abspath(dataDirectory)
+    name = os.path.basename(dataDirectory.rstrip(os.sep))
+    digest = hashlib.sha1(dataDirectory.encode()).hexdigest()[:8]
+    return 'manifest_'+name+'_'+digest+'_'+extension+'.csv'
+
+def observationTime(filename):
+    # observation time YYYYMMDD_HHMMSS from the hmi.M_720s.YYYYMMDD_HHMMSS_TAI
+    # part of the filename, or '' if not found
+    match = re.search(r'(\d{8})_(\d{6})',filename)
+    if match is None:
+        return ''
+    return match.group(1)+'_'+match.group(2)
+
+def scanFolder(dataDirectory,folder,extension):
+    # list the image files of one AR folder
+    entries = []
+    with os.scandir(os.path.join(dataDirectory,folder)) as it:
+        for item in it:
+            if item.name.endswith('.'+extension) and item.is_file():
+                stat = item.stat()
+                entries.append(Entry(folder+'/'+item.name,folder,
+                                     observationTime(item.name),
+                                     stat.st_size,stat.st_mtime_ns))
+    return entries
+
+def readManifest(manifestFile):
+    # returns the image entries and the modification time of each AR folder
+    entries = []
+    folders = dict()
+    with open(manifestFile) as f:
+        for row in csv.reader(f,delimiter = ','):
+            if row[0].startswith('#'):
+                continue
+            if row[0].endswith('/'):
+                folders[row[1]] = int(row[4])
+            else:
+                entries.append(Entry(row[0],row[1],row[2],int(row[3]),int(row[4])))
+    return entries,folders
+
+def writeManifest(manifestFile,entries,folders):
+    # written to a temporary file first, so that an interrupted write never
+    # leaves a partial manifest
+    with open(manifestFile+'.tmp','w',newline='') as f:
+        f.write('# '+','.join(header)+'\n')
+        writer = csv.writer(f,delimiter = ',')
+        for folder in sorted(folders):
+            writer.writerow([folder+'/',folder,'',0,folders[folder]])
+        for entry in entries:
+            writer.writerow(entry)
+    os.replace(manifestFile+'.tmp',manifestFile)
+
+def buildManifest(dataDirectory,extension,manifestFile=None,refresh=True,
+                  workers=16):
+    """
+    Returns the list of Entry for all files with the given extension in the AR
+    folders of dataDirectory, sorted by path. The manifest is read from
+    manifestFile (default: defaultManifestFile, in the working directory) if
+    it exists, and with refresh=True updated for AR folders that were added,
+    removed or modified since it was written. AR folders are listed in
+    parallel with the given number of threads. If the manifest cannot be
+    written, a warning is printed and the entries are still returned.
+    """
+
+    if manifestFile is None:
+        manifestFile = defaultManifestFile(dataDirectory,extension)
+    entries = []
+    folders = dict()
+    if os.path.exists(manifestFile):
+        entries,folders = readManifest(manifestFile)
+        if not refresh:
+            return entries
+
+    # Find AR folders that are new or modified
+    current = dict()
+    with os.scandir(dataDirectory) as it:
+        for item in it:
+            if item.is_dir():
+                current[item.name] = item.stat().st_mtime_ns
+    changed = [folder for folder in current if folders.get(folder) != current[folder]]
+    if not changed and set(current) == set(folders):
+        return entries
+
+    # Keep entries of unchanged folders and list the changed ones in parallel
+    entries = [entry for entry in entries
+               if entry.ar in current and entry.ar not in changed]
+    with ThreadPoolExecutor(workers) as pool:
+        for folderEntries in pool.map(lambda folder: scanFolder(dataDirectory,folder,extension),
+                                      changed):
+            entries.extend(folderEntries)
+    entries.sort(key=lambda entry: entry.path)
+    print('Dataset manifest: listed '+str(len(changed))+' of '+str(len(current))+
+          ' AR folders, '+str(len(entries))+' files')
+    try:
+        writeManifest(manifestFile,entries,current)
+    except OSError as error:
+        # e.g. read-only location, the next run lists the folders again
+        print('Dataset manifest not saved: '+str(error))
+    return entries
+
+def listFiles(dataDirectory,extension,manifestFile=None,refresh=True):
+    """
+    Returns the sorted full paths of all files with the given extension in the
+    AR folders of dataDirectory, from the dataset manifest. Equivalent to
+    sorted(glob.glob(dataDirectory+'/*/*.'+extension)).
+    """
+
+    entries = buildManifest(dataDirectory,extension,manifestFile,refresh)
+    return [os.path.join(dataDirectory,entry.path) for entry in entries]
+
+def filesByAR(dataDirectory,extension,manifestFile=None,refresh=True):
+    """
+    Returns a dict mapping each AR folder name to the sorted filenames (not
+    full paths) of its files with the given extension.
+    """
+
+    byAR = dict()
+    for entry in buildManifest(dataDirectory,extension,manifestFile,refresh):
+        byAR.setdefault(entry.ar,[]).append(os.path.basename(entry.path))
+    return byAR
@@ -0,0 +1,158 @@
+# DESCRIPTION: Shared reader for the SDO HMI magnetogram patches of the AR
+#              Dataset (image in HDU 1 of each fits file). The reference path
+#              (astropy fits.open, verify('silentfix') and a copy of the
+#              big-endian HDU 1 data) parses and verifies every header card of
+#              every file at every read. Here the headers are only parsed for
+#              the structural keywords needed to find the byte offset, dtype,
+#              shape and scaling of the image data, which is then
+#              memory-mapped; the other cards are not verified, as they do not
+#              affect the image. Any file whose header can not be parsed
+#              strictly, or whose image is not a plain image extension (e.g.,
+#              tile-compressed images, as exported by JSOC), is read with the
+#              reference path, verify('silentfix') included. The layout of
+#              each file is cached (keyed by path, size and mtime) for repeat
+#              reads in the same process (e.g., every epoch of a training run).
+#
+#  - Benchmark_MagnetogramReader.py compares the read rate of both paths.
+#
+# References:
+# [1] L. E. Boucheron, T. Vincent, J. A. Grajeda, and E. Wuest, "Solar Active
+#     Region Magnetogram Image Dataset for Studies of Space Weather," arXiv
+#     preprint arXiv:2305.09492, 2023.
+#
+# Copyright 2022 Ty Vincent, Laura Boucheron
+# This file is part of AR-flares
+#
+# AR-flares is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# AR-flares is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# AR-flares. If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import numpy as np
+from collections import namedtuple
+from astropy.io import fits
+
+blockSize = 2880 # fits files are written in blocks of 2880 bytes
+cardSize = 80 # header cards are 80 characters
+
+# data types of the fits BITPIX values, big-endian
+bitpixTypes = {8:'u1',16:'>i2',32:'>i4',64:'>i8',-32:'>f4',-64:'>f8'}
+
+# Byte offset, dtype, shape and scaling of the image data of a fits file
+# (layout None if the image can not be memory-mapped)
+Layout = namedtuple('Layout',['offset','dtype','shape','bscale','bzero','blank'])
+
+layoutCache = dict() # (path, size, mtime) -> Layout or None
+
+def parseHeader(f):
+    # parse the cards of one header starting at the current position of f,
+    # returns the structural keywords and the position of the data
+    keywords = dict()
+    while True:
+        block = f.read(blockSize)
+        if len(block)<blockSize:
+            raise ValueError('Truncated fits header')
+        block = block.decode('ascii')
+        for i in range(0,blockSize,cardSize):
+            key = block[i:i+8].rstrip()
+            if key=='END':
+                return keywords, f.tell()
+            if block[i+8:i+10]=='= ' and key in ('SIMPLE','XTENSION','BITPIX',
+                'NAXIS','NAXIS1','NAXIS2','NAXIS3','PCOUNT','GCOUNT','BSCALE',
+                'BZERO','BLANK','ZIMAGE','GROUPS'):
+                value = block[i+10:i+cardSize]
+                if value.lstrip().startswith("'"):
+                    keywords[key] = value.split("'")[1].rstrip()
+                else:
+                    keywords[key] = value.split('/')[0].strip()
+
+def dataSize(keywords):
+    # size in bytes of the data following a header, padded to full blocks
+    naxis = int(keywords['NAXIS'])
+    if naxis==0:
+        return 0
+    size = 1
+    for n in range(1,naxis+1):
+        size = size*int(keywords['NAXIS'+str(n)])
+    size = abs(int(keywords['BITPIX']))//8*int(keywords.get('GCOUNT',1))*\
+           (int(keywords.get('PCOUNT',0))+size)
+    return -(-size//blockSize)*blockSize
+
+def readLayout(filename,hdu=1):
+    """
+    Parses the headers of a fits file up to the given HDU and returns the
+    Layout of its image data, or None if the HDU is not a plain image (e.g., a
+    tile-compressed image stored as a binary table).
+    """
+
+    with open(filename,'rb') as f:
+        try:
+            for n in range(hdu):
+                keywords, position = parseHeader(f)
+                f.seek(position+dataSize(keywords))
+            keywords, offset = parseHeader(f)
+        except (ValueError,KeyError,UnicodeDecodeError):
+            return None
+    if keywords.get('XTENSION')!='IMAGE' or keywords.get('ZIMAGE')=='T' or \
+       int(keywords.get('BITPIX',0)) not in bitpixTypes or \
+       int(keywords.get('NAXIS',0))!=2:
+        return None
+    try:
+        shape = (int(keywords['NAXIS2']),int(keywords['NAXIS1']))
+        bscale = float(keywords.get('BSCALE',1))
+        bzero = float(keywords.get('BZERO',0))
+        blank = int(keywords['BLANK']) if 'BLANK' in keywords else None
+    except ValueError:
+        return None
+    return Layout(offset,bitpixTypes[int(keywords['BITPIX'])],shape,bscale,
+                  bzero,blank)
+
+def getLayout(filename):
+    # layout of a file from the cache, parsed again if the file changed
+    stat = os.stat(filename)
+    key = (os.path.abspath(filename),stat.st_size,stat.st_mtime_ns)
+    if key not in layoutCache:
+        layoutCache[key] = readLayout(filename)
+    return layoutCache[key]
+
+def readMagnetogram(filename,dtype=float,verify=False):
+    """
+    Returns the image in HDU 1 of a fits file as a native-endian array of the
+    requested dtype, with the BSCALE/BZERO scaling and BLANK values applied as
+    in astropy. With dtype=None the memory-mapped (big-endian, read-only) data
+    is returned without a copy when the image is not scaled. Files that can
+    not be memory-mapped, or all files with verify=True, are read with astropy
+    and verify('silentfix').
+    """
+
+    layout = None if verify else getLayout(filename)
+    if layout is None:
+        with fits.open(filename) as hdulist:
+            hdulist.verify('silentfix')
+            return np.asarray(hdulist[1].data,dtype=dtype)
+    data = np.memmap(filename,dtype=layout.dtype,mode='r',offset=layout.offset,
+                     shape=layout.shape)
+    if layout.bscale!=1 or layout.bzero!=0 or layout.blank is not None:
+        # scaled as in astropy, in float32 for 8 and 16 bit integers
+        if layout.dtype in ('u1','>i2'):
+            scaled = data.astype(np.float32)
+        else:
+            scaled = data.astype(np.float64)
+        if layout.bscale!=1:
+            scaled *= layout.bscale
+        if layout.bzero!=0:
+            scaled += layout.bzero
+        if layout.blank is not None:
+            scaled[data==layout.blank] = np.nan
+        data = scaled
+    if dtype is None:
+        return data
+    return np.asarray(data,dtype=dtype)
@@ -37,6 +37,8 @@ import numpy as np
 import shutil
 import glob
 import pdb
+import DatasetManifest
+import MagnetogramReader
 from datetime import datetime
 from datetime import timedelta
 from astropy.io import fits
@@ -134,22 +136,21 @@ def nanSeparation(latLonFileArray,cfg):
     
     nanFileArray = [] # list to store filenames that don't satisfy NaN check
     num_nanFiles = 0 # counter for files that don't satisfy NaN check
+    # list all fits files in dataset from the dataset manifest
+    filesByAR = DatasetManifest.filesByAR(cfg['dataDirectory'],'fits')
     # loop over all directories in dataset
-    for direc in sorted(os.listdir(cfg['dataDirectory'])):
+    for direc in sorted(filesByAR):
         i = 0 # counter for files per NOAA AR that don't satisfy NaN check
         print('Processing AR '+direc)
         # grab number of NOAA AR files for status update later
-        num_files = len(glob.glob(cfg['dataDirectory']+direc+'/*.fits'))
+        num_files = len(filesByAR[direc])
         # loop over all files in NOAA AR directory
-        for fit in sorted(glob.glob(cfg['dataDirectory']+direc+'/*.fits')):
-            baseFit = os.path.basename(fit)
-            baseFit = direc+'_'+baseFit.split('_')[0] + '_'+ baseFit.split('_')[1]
+        for fitName in filesByAR[direc]:
+            fit = cfg['dataDirectory']+direc+'/'+fitName
+            baseFit = direc+'_'+fitName.split('_')[0] + '_'+ fitName.split('_')[1]
             if baseFit not in latLonFileArray:
-                # open file and fix fits errors
-                hdulist = fits.open(fit)
-                hdulist.verify('silentfix')
-                # grab fits image    
-                fitsIm = hdulist[1].data
+                # open file, fix fits errors and grab fits image
+                fitsIm = MagnetogramReader.readMagnetogram(fit,verify=True)
                 # count number of NaNs in image
                 numNan = np.isnan(fitsIm).sum()
                 # if NaNs exceeds specified number, add filename to list
@@ -182,17 +183,18 @@ def createDataset(nanFileArray, latLonFileArray, cfg ):
         os.mkdir(cfg["newDataDirectory"])                
 
     print("*****Copying Valid Data*****")
+    # list all fits files in dataset from the dataset manifest
+    filesByAR = DatasetManifest.filesByAR(cfg['dataDirectory'],'fits')
     # Loop over AR folders
-    for direc in sorted(os.listdir(cfg["dataDirectory"])):
+    for direc in sorted(filesByAR):
     
         print("*********************" + str(direc)+ "**********************")
         i = 0
         j = 0
         # Loop over fits files in folders
-        num_files = len(glob.glob(cfg['dataDirectory']+direc+'/*.fits'))
+        num_files = len(filesByAR[direc])
         # ignore last file in AR since from just after midnight last day
-        for f in sorted(glob.glob(cfg['dataDirectory']+direc+'/*.fits'))[:-1]:
-            fit = os.path.basename(f)
+        for fit in filesByAR[direc][:-1]:
             
             # Prepend NOAA number
             newFit = str(direc) + '_' + str(fit)
@@ -275,6 +277,8 @@ def createLabelCsv( filesMoved, cfg ):
                 flareFiles.append(line.split(',')[0])
                 flareSizes.append(line.split(',')[1])
     else: 
+        # list all fits files in new dataset from the dataset manifest
+        newFilesByAR = DatasetManifest.filesByAR(cfg['newDataDirectory'],'fits')
         with open('eventList.txt','r') as f: # eventList contains all flares
             for line in f: # loop over all events
                 line = line.split(',') # split current line by commas
@@ -308,9 +312,9 @@ def createLabelCsv( filesMoved, cfg ):
                         tdelta = timedelta(hours=cfg['classification']['flareTime']) 
     
                         # check for existence of files in NOAA directory
-                        if os.path.exists(cfg['newDataDirectory']+noaa):
+                        if noaa in newFilesByAR:
                             # loop over contents of current NOAA AR directory
-                            for fitsF in sorted(os.listdir(cfg['newDataDirectory']+noaa)): 
+                            for fitsF in newFilesByAR[noaa]: 
                                 try: 
                                     # strip off date-time string from fits file
                                     fitsTime_str = fitsF.split('.')[2] 
@@ -365,13 +369,11 @@ def createLabelCsv( filesMoved, cfg ):
     num_notflareFiles_total = 0
     num_notflareFiles = 0
     # loop over all AR directories
-    noaas = sorted(glob.glob(cfg['newDataDirectory']+'*'))
-    for noaa in noaas:
+    newFilesByAR = DatasetManifest.filesByAR(cfg['newDataDirectory'],'fits')
+    for noaa in sorted(newFilesByAR):
         # loop over all fits files in AR directory
         num_notflareFiles = 0
-        fitsFiles = sorted(glob.glob(noaa+'/*.fits'))
-        for fitsFile in fitsFiles:
-            fit = os.path.basename(fitsFile)
+        for fit in newFilesByAR[noaa]:
             # check if current fits file already included in flareFiles 
             if not fit in flareFiles:
                 num_notflareFiles = num_notflareFiles+1
@@ -379,7 +381,7 @@ def createLabelCsv( filesMoved, cfg ):
                 # write out fits file with label of '0'
                 f.write(fit+',0\n')
                 # print status
-        print('AR '+noaa.split('/')[-1]+': '+\
+        print('AR '+noaa+': '+\
               str(num_notflareFiles)+' non-flare files '+\
               str(num_notflareFiles_total)+' non-flare files total')
     f.close()